@@ -0,0 +1,101 @@
+from typing import Optional, Sequence
+
+import numpy
+
+
+def _choose(
+    label_need: numpy.ndarray, size_need: numpy.ndarray, rng: numpy.random.Generator
+) -> int:
+    """
+    The split that needs the label the most, breaking ties
+    by the split that needs the most docs and then at random.
+    """
+    best = numpy.flatnonzero(label_need == label_need.max())
+    if len(best) > 1:
+        best = best[size_need[best] == size_need[best].max()]
+    if len(best) > 1:
+        return int(rng.choice(best))
+    return int(best[0])
+
+
+def stratified_split(
+    n_docs: int,
+    span_doc_id: numpy.ndarray,
+    span_label: numpy.ndarray,
+    sizes: Sequence[float],
+    *,
+    groups: Optional[numpy.ndarray] = None,
+    seed: Optional[int] = None,
+) -> numpy.ndarray:
+    """
+    Multi-label iterative stratification (Sechidis et al., 2011)
+    of 'n_docs' docs into splits of relative 'sizes', based on the
+    labels of their spans. The spans are given as the doc each span
+    is in and its label id, like in _util.SpanIndex. Docs with the
+    same value in 'groups' always end up in the same split. Returns
+    the index of the split of each doc.
+
+    The labels are handled from the rarest to the most common one,
+    and each group with the label goes to the split that still
+    needs the most spans of it, so rare labels are spread over all
+    splits instead of landing in train by chance.
+    """
+    rng = numpy.random.default_rng(seed)
+    sizes = numpy.asarray(sizes, dtype="float64") / sum(sizes)
+    if groups is None:
+        unit_of_doc = numpy.arange(n_docs)
+    else:
+        _, unit_of_doc = numpy.unique(numpy.asarray(groups), return_inverse=True)
+    n_units = int(unit_of_doc.max()) + 1 if n_docs else 0
+    unit_docs = numpy.bincount(unit_of_doc, minlength=n_units)
+    span_label = numpy.asarray(span_label, dtype="int64")
+    n_labels = int(span_label.max()) + 1 if len(span_label) else 0
+    # Number of spans of each label per group as sorted (unit, label) pairs.
+    pairs = unit_of_doc[numpy.asarray(span_doc_id, dtype="int64")] * n_labels + span_label
+    pairs, counts = numpy.unique(pairs, return_counts=True)
+    pair_unit = pairs // max(n_labels, 1)
+    pair_label = pairs % max(n_labels, 1)
+    unit_starts = numpy.searchsorted(pair_unit, numpy.arange(n_units + 1))
+    by_label = numpy.argsort(pair_label, kind="stable")
+    label_starts = numpy.searchsorted(pair_label[by_label], numpy.arange(n_labels + 1))
+
+    size_need = sizes * n_docs
+    label_need = sizes[:, None] * numpy.bincount(pair_label, counts, minlength=n_labels)[None, :]
+    remaining = numpy.bincount(pair_label, minlength=n_labels).astype("float64")
+    assigned = numpy.full(n_units, -1, dtype="int64")
+    while n_labels and remaining.max() > 0:
+        label = int(numpy.argmin(numpy.where(remaining > 0, remaining, numpy.inf)))
+        units = pair_unit[by_label[label_starts[label]:label_starts[label + 1]]]
+        units = rng.permutation(units[assigned[units] < 0])
+        for unit in units:
+            split = _choose(label_need[:, label], size_need, rng)
+            assigned[unit] = split
+            start, end = unit_starts[unit], unit_starts[unit + 1]
+            label_need[split, pair_label[start:end]] -= counts[start:end]
+            size_need[split] -= unit_docs[unit]
+            remaining[pair_label[start:end]] -= 1
+    # Groups without spans fill up the splits to their sizes.
+    unlabelled = rng.permutation(numpy.flatnonzero(assigned < 0))
+    if len(unlabelled):
+        need = numpy.clip(size_need, 0, None)
+        if need.sum() == 0:
+            need = sizes.copy()
+        bounds = numpy.cumsum(need / need.sum())[:-1] * unit_docs[unlabelled].sum()
+        filled = numpy.cumsum(unit_docs[unlabelled]) - unit_docs[unlabelled]
+        assigned[unlabelled] = numpy.searchsorted(bounds, filled, side="right")
+    return assigned[unit_of_doc].astype("int8")
+
+
+def kfold_split(
+    n_docs: int, n_folds: int, *, shuffle: bool = False, seed: Optional[int] = None
+) -> numpy.ndarray:
+    """
+    Assigns the docs to 'n_folds' folds of (nearly) equal
+    size, in order or after a seeded shuffle.
+    """
+    order = numpy.arange(n_docs)
+    if shuffle:
+        order = numpy.random.default_rng(seed).permutation(n_docs)
+    folds = numpy.empty(n_docs, dtype="int8")
+    folds[order] = numpy.arange(n_docs) * n_folds // max(n_docs, 1)
+    return folds
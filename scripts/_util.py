@@ -1,17 +1,57 @@
 import os
+import json
+import zlib
+import array
+import random
+import shutil
+import hashlib
+import zipfile
 
+from bisect import bisect_right
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Union, Tuple, Dict
+from typing import Union, Tuple, Dict, Iterable, Iterator, Sequence, List, Optional, Callable, Set
 from collections import defaultdict
+from itertools import accumulate
 
-from spacy.tokens import DocBin
-from spacy.util import ensure_path
+import numpy
+import srsly
+from spacy.attrs import intify_attr
+from spacy.strings import hash_string
+from spacy.tokens import Doc, DocBin, SpanGroup
+from spacy.training import Corpus
+from spacy.util import ensure_path, get_model_meta, get_package_path, is_package, registry
+from spacy.vocab import Vocab
+from wasabi import Printer
 
 
 format_error = ("Incorrect file name {path}."
                 "(lang)-source-split-(seen/unseen).spacy")
 
+# Maximum size of an OutputCache in GB.
+CACHE_SIZE = 10.0
+# Suffix of the sidecar manifest with the number of docs, label counts
+# and content hash of each shard of a corpus.
+INDEX_SUFFIX = ".index.json"
+# Suffix of the sidecar file with the SpanIndex of a corpus.
+SPAN_INDEX_SUFFIX = ".spans.npz"
+# Suffix of the files with the held out doc ids of each fold of a corpus.
+FOLD_SUFFIX = ".fold-{fold}.npy"
+# Name of the catalog of the corpora in the home directory of info().
+CATALOG_NAME = "catalog.json"
+# Token attributes stored by each DocBin profile, on top of ORTH and SPACY
+# which a DocBin always stores. None keeps DocBin's defaults and user data.
+# SENT_START is always kept, so docs of several sentences keep their
+# boundaries; dropping it would mark only the first token as a start.
+DOCBIN_PROFILES: Dict[str, Optional[List[str]]] = {
+    "minimal": ["SENT_START"],
+    "ner": ["SENT_START", "ENT_IOB", "ENT_TYPE", "ENT_KB_ID", "ENT_ID"],
+    "full": None,
+}
+COMPRESSIONS = ("zlib", "zstd")
+# The first bytes of a zstd frame, which zlib data never starts with.
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
 
 @dataclass
 class SplitInfo:
@@ -29,8 +69,17 @@ class SplitInfo:
     languages like "es-conll-train.spacy" and "nl-conll-train.spacy"
     it stores "es-conll" or "nl-conll" as .source, but
     "conll" as .dataset for both.
+
+    info() also fills in the size in bytes, content hash,
+    number of docs and tokens and the number of spans of
+    each label of the split from the corpus catalog.
     """
     path: Union[Path, str]
+    size: Optional[int] = None
+    hash: Optional[str] = None
+    n_docs: Optional[int] = None
+    n_tokens: Optional[int] = None
+    labels: Optional[Dict[str, int]] = None
 
     def __post_init__(self):
         self.path = ensure_path(self.path)
@@ -68,6 +117,1043 @@ class SplitInfo:
             self.lang = "xx"
         self.dataset = source
 
+    def load(self) -> "LazyDocBin":
+        return LazyDocBin(self.path)
+
+    def corpus(self, **kwargs) -> "ShardedCorpus":
+        """The split as a streaming ShardedCorpus."""
+        return ShardedCorpus(self.path, **kwargs)
+
+    def manifest(self) -> Dict:
+        return read_manifest(self.path)
+
+
+def shard_paths(path: Union[Path, str]) -> List[Path]:
+    """
+    Returns the DocBin files of a corpus, which is
+    either a single .spacy file or a directory
+    of .spacy shards.
+    """
+    path = ensure_path(path)
+    if path.is_dir():
+        return sorted(p for p in path.iterdir() if p.suffix == ".spacy")
+    return [path]
+
+
+def _index_path(path: Path) -> Path:
+    return path.parent / f"{path.name}{INDEX_SUFFIX}"
+
+
+def _file_hash(path: Path) -> str:
+    hasher = hashlib.blake2b(digest_size=16)
+    _update_hash(hasher, path)
+    return hasher.hexdigest()
+
+
+def _shard_stat(shard: Path) -> Dict:
+    stat = shard.stat()
+    return {"name": shard.name, "size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def _shard_entry(
+    shard: Path, n_docs: int, labels: Optional[Dict[str, int]] = None
+) -> Dict:
+    entry = {**_shard_stat(shard), "n_docs": n_docs, "hash": _file_hash(shard)}
+    if labels is not None:
+        entry["labels"] = labels
+    return entry
+
+
+def _is_fresh(entry: Dict, shard: Path) -> bool:
+    return all(entry.get(key) == value for key, value in _shard_stat(shard).items())
+
+
+def _shard_labels(span_index: "SpanIndex", n_docs: Sequence[int]) -> List[Dict[str, int]]:
+    """The number of spans of each label in each shard."""
+    offsets = numpy.cumsum([0, *n_docs])
+    shard = numpy.searchsorted(offsets, span_index.doc_id, side="right") - 1
+    n_labels = len(span_index.labels)
+    counts = numpy.bincount(
+        shard * n_labels + span_index.label, minlength=len(n_docs) * n_labels
+    ).reshape(len(n_docs), n_labels)
+    return [
+        {label: int(count) for label, count in zip(span_index.labels, row) if count}
+        for row in counts
+    ]
+
+
+def _manifest(entries: List[Dict], spans_key: Optional[str] = None) -> Dict:
+    labels: Dict[str, int] = defaultdict(int)
+    for entry in entries:
+        for label, count in entry.get("labels", {}).items():
+            labels[label] += count
+    return {
+        "n_docs": sum(entry["n_docs"] for entry in entries),
+        "spans_key": spans_key,
+        "labels": dict(labels),
+        "shards": entries,
+    }
+
+
+def _write_manifest(path: Path, manifest: Dict) -> None:
+    with _index_path(path).open("w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+
+
+def write_doc_index(
+    path: Union[Path, str],
+    n_docs: Sequence[int],
+    span_index: Optional["SpanIndex"] = None,
+) -> None:
+    """
+    Writes the sidecar manifest of a corpus given the number of docs
+    in each of its shards. Each shard gets an entry with its number
+    of docs and a hash of its contents, and with 'span_index' also
+    the number of spans of each label in it.
+    """
+    path = ensure_path(path)
+    shards = shard_paths(path)
+    if span_index is None:
+        entries = [_shard_entry(shard, n) for shard, n in zip(shards, n_docs)]
+        spans_key = None
+    else:
+        labels = _shard_labels(span_index, n_docs)
+        entries = [_shard_entry(*entry) for entry in zip(shards, n_docs, labels)]
+        spans_key = span_index.spans_key
+    _write_manifest(path, _manifest(entries, spans_key))
+
+
+def read_manifest(path: Union[Path, str]) -> Dict:
+    """
+    Returns the sidecar manifest of a corpus. Shards that are
+    missing from it or whose contents changed since are loaded
+    to count their docs, without their label counts, and the
+    manifest is updated.
+    """
+    path = ensure_path(path)
+    index_path = _index_path(path)
+    manifest = {"spans_key": None, "shards": []}
+    if index_path.exists():
+        with index_path.open(encoding="utf-8") as f:
+            manifest = json.load(f)
+    entries = {e["name"]: e for e in manifest["shards"]}
+    shards = []
+    stale = False
+    for shard in shard_paths(path):
+        entry = entries.get(shard.name)
+        if entry is not None and _is_fresh(entry, shard) and "hash" in entry:
+            shards.append(entry)
+            continue
+        stale = True
+        content_hash = _file_hash(shard)
+        if entry is not None and (
+            entry.get("hash") == content_hash
+            # Written before the manifests had hashes.
+            or ("hash" not in entry and _is_fresh(entry, shard))
+        ):
+            entry = {**entry, **_shard_stat(shard), "hash": content_hash}
+        else:
+            entry = _shard_entry(shard, len(load_docbin(shard)))
+        shards.append(entry)
+    if stale or len(entries) != len(shards):
+        manifest = _manifest(shards, manifest.get("spans_key"))
+        try:
+            _write_manifest(path, manifest)
+        except OSError:
+            pass
+    return manifest
+
+
+def read_doc_index(path: Union[Path, str]) -> List[int]:
+    """
+    Returns the number of docs in each shard of a corpus
+    from its sidecar manifest, see read_manifest.
+    """
+    return [entry["n_docs"] for entry in read_manifest(path)["shards"]]
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError(
+            "zstd compressed corpora need the 'zstandard' package: "
+            "pip install zstandard"
+        ) from None
+    return zstandard
+
+
+@dataclass
+class DocBinFormat:
+    """
+    How the DocBins of a corpus are written: the token attributes
+    of 'profile' (one of DOCBIN_PROFILES) and the 'compression'
+    ("zlib" or "zstd") with an optional 'level'. spaCy reads zlib
+    corpora of any level. zstd corpora need the optional zstandard
+    package and are read with load_docbin, which LazyDocBin and the
+    readers in this module use, but spaCy's own Corpus reader doesn't.
+    """
+    profile: str = "full"
+    compression: str = "zlib"
+    level: Optional[int] = None
+
+    def __post_init__(self):
+        if self.profile not in DOCBIN_PROFILES:
+            raise ValueError(f"Unknown DocBin profile '{self.profile}', expected one of {list(DOCBIN_PROFILES)}")
+        if self.compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression '{self.compression}', expected one of {COMPRESSIONS}")
+
+    @classmethod
+    def from_options(
+        cls, profile: str = "auto", compression: str = "zlib", *, spans: bool = True
+    ) -> "DocBinFormat":
+        """
+        The format for the --attrs-profile and --compression options
+        of the scripts. The "auto" profile is "minimal" for Doc.spans
+        corpora and "ner" for Doc.ents corpora, and the compression
+        can have a level like "zstd:19".
+        """
+        if profile == "auto":
+            profile = "minimal" if spans else "ner"
+        name, _, level = compression.partition(":")
+        return cls(profile, name, int(level) if level else None)
+
+    @property
+    def attrs(self) -> Optional[List[int]]:
+        attrs = DOCBIN_PROFILES[self.profile]
+        return None if attrs is None else [intify_attr(attr) for attr in ["ORTH", *attrs]]
+
+    def docbin(self, docs: Iterable[Doc] = ()) -> DocBin:
+        if self.attrs is None:
+            return DocBin(store_user_data=True, docs=docs)
+        return DocBin(attrs=self.attrs, docs=docs)
+
+    def project(self, docbin: DocBin) -> DocBin:
+        """
+        Keeps the columns of the profile's attributes of a DocBin and
+        drops its user data, without creating Docs. Attributes the
+        DocBin doesn't have are stored as unset (0).
+        """
+        if self.attrs is None:
+            return docbin
+        projected = self.docbin()
+        if projected.attrs == docbin.attrs and not docbin.store_user_data:
+            return docbin
+        columns = [docbin.attrs.index(attr) if attr in docbin.attrs else -1 for attr in projected.attrs]
+        for tokens in docbin.tokens:
+            # The extra zero column stands in for missing attributes.
+            padded = numpy.hstack([tokens, numpy.zeros((len(tokens), 1), dtype=tokens.dtype)])
+            projected.tokens.append(numpy.ascontiguousarray(padded[:, columns]))
+        projected.strings = docbin.strings
+        projected.spaces = docbin.spaces
+        projected.cats = docbin.cats
+        projected.span_groups = docbin.span_groups
+        projected.flags = docbin.flags
+        projected.user_data = [None] * len(docbin)
+        return projected
+
+    def to_bytes(self, docbin: DocBin) -> bytes:
+        docbin = self.project(docbin)
+        if self.compression == "zlib" and self.level is None:
+            return docbin.to_bytes()
+        data = zlib.decompress(docbin.to_bytes())
+        if self.compression == "zstd":
+            level = 3 if self.level is None else self.level
+            return _zstd().ZstdCompressor(level=level).compress(data)
+        return zlib.compress(data, self.level)
+
+    def to_disk(self, docbin: DocBin, path: Union[Path, str]) -> None:
+        with ensure_path(path).open("wb") as f:
+            f.write(self.to_bytes(docbin))
+
+
+def docbin_from_bytes(data: bytes) -> DocBin:
+    """
+    Deserializes a DocBin written with any DocBinFormat.
+    zstd data is handed to DocBin.from_bytes as uncompressed
+    (level 0) zlib, which costs a copy but no compression.
+    """
+    if data.startswith(ZSTD_MAGIC):
+        data = _zstd().ZstdDecompressor().decompress(data)
+        data = zlib.compress(data, 0)
+    return DocBin().from_bytes(data)
+
+
+def load_docbin_msg(path: Union[Path, str]) -> Dict:
+    """
+    The deserialized msgpack message of a DocBin written with any
+    DocBinFormat, with the arrays of all docs as flat bytes.
+    """
+    with ensure_path(path).open("rb") as f:
+        data = f.read()
+    if data.startswith(ZSTD_MAGIC):
+        data = _zstd().ZstdDecompressor().decompress(data)
+    else:
+        data = zlib.decompress(data)
+    return srsly.msgpack_loads(data)
+
+
+def load_docbin(path: Union[Path, str]) -> DocBin:
+    """DocBin().from_disk for DocBins written with any DocBinFormat."""
+    with ensure_path(path).open("rb") as f:
+        return docbin_from_bytes(f.read())
+
+
+def select_docs(docbin: DocBin, indices: Sequence[int]) -> DocBin:
+    """
+    Returns a DocBin with the docs at 'indices' in 'docbin',
+    copying their serialized annotations without creating Docs.
+    """
+    selected = DocBin(store_user_data=docbin.store_user_data)
+    selected.attrs = docbin.attrs
+    selected.tokens = [docbin.tokens[i] for i in indices]
+    selected.spaces = [docbin.spaces[i] for i in indices]
+    selected.cats = [docbin.cats[i] for i in indices]
+    selected.span_groups = [docbin.span_groups[i] for i in indices]
+    selected.flags = [docbin.flags[i] for i in indices]
+    selected.user_data = [docbin.user_data[i] for i in indices]
+    hashes = _string_hashes(selected)
+    selected.strings = {string for string in docbin.strings if hash_string(string) in hashes}
+    return selected
+
+
+def _string_hashes(docbin: DocBin) -> Set[int]:
+    """
+    The hashes of the strings the docs of 'docbin' refer to: the
+    values of their token attributes and the ids, KB ids and labels
+    of their spans. Values of attributes that aren't strings may be
+    included too, which can only keep a few strings too many.
+    """
+    hashes: Set[int] = set()
+    for tokens in docbin.tokens:
+        hashes.update(numpy.unique(tokens).tolist())
+    for span_groups in docbin.span_groups:
+        groups = srsly.msgpack_loads(span_groups) if span_groups else []
+        for group in groups:
+            spans = srsly.msgpack_loads(group)["spans"]
+            if spans:
+                # Spans are packed as ">QQQllll": id, kb_id, label, offsets.
+                fields = numpy.frombuffer(b"".join(spans), dtype=">u8").reshape(-1, 5)
+                hashes.update(numpy.unique(fields[:, :3]).tolist())
+    return hashes
+
+
+class LazyDocBin:
+    """
+    Read-only view of a corpus that only deserializes
+    the shards it needs. The number of docs comes from
+    the sidecar index, so len() doesn't load anything.
+    get_doc creates just the i-th Doc from its slice of
+    the serialized arrays and only adds its strings to
+    the vocab, but a DocBin is compressed as a whole, so
+    the first get_doc in a shard still decompresses all
+    of it. For random access to large corpora, write
+    them with --shard-size. It can be used in place of
+    a DocBin for len() and get_docs.
+    """
+    def __init__(self, path: Union[Path, str]):
+        self.path = ensure_path(path)
+        self.shards = shard_paths(self.path)
+        self.n_docs = read_doc_index(self.path)
+        self.offsets = [0] + list(accumulate(self.n_docs))
+        self._shard: Optional[Tuple[int, Dict, numpy.ndarray, Dict[int, str]]] = None
+
+    def __len__(self) -> int:
+        return self.offsets[-1]
+
+    def _load_shard(self, shard_id: int) -> Tuple[Dict, numpy.ndarray, Dict[int, str]]:
+        """
+        The DocBin message of a shard, the token offset of each
+        of its docs and its strings by hash, for the last shard.
+        """
+        if self._shard is None or self._shard[0] != shard_id:
+            msg = load_docbin_msg(self.shards[shard_id])
+            lengths = numpy.frombuffer(msg["lengths"], dtype="int32")
+            token_offsets = numpy.concatenate([[0], numpy.cumsum(lengths, dtype="int64")])
+            strings = {hash_string(string): string for string in msg["strings"]}
+            self._shard = (shard_id, msg, token_offsets, strings)
+        return self._shard[1:]
+
+    def get_doc(self, i: int, vocab: Vocab) -> Doc:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"Doc index {i} out of range for {self.path}")
+        shard_id = bisect_right(self.offsets, i) - 1
+        msg, token_offsets, strings = self._load_shard(shard_id)
+        j = i - self.offsets[shard_id]
+        start, end = int(token_offsets[j]), int(token_offsets[j + 1])
+        n_attrs = len(msg["attrs"])
+        single = DocBin()
+        single.attrs = msg["attrs"]
+        single.tokens = [numpy.frombuffer(
+            msg["tokens"], dtype="uint64", count=(end - start) * n_attrs, offset=start * n_attrs * 8
+        ).reshape(end - start, n_attrs)]
+        single.spaces = [numpy.frombuffer(
+            msg["spaces"], dtype=bool, count=end - start, offset=start
+        ).reshape(end - start, 1)]
+        single.cats = [msg["cats"][j]]
+        single.span_groups = [msg["span_groups"][j] if "span_groups" in msg else b""]
+        single.flags = [msg["flags"][j] if "flags" in msg else {}]
+        single.user_data = [msg["user_data"][j] if "user_data" in msg else None]
+        single.strings = {strings[h] for h in _string_hashes(single) if h in strings}
+        return next(single.get_docs(vocab))
+
+    def get_docs(self, vocab: Vocab) -> Iterator[Doc]:
+        for shard in self.shards:
+            yield from load_docbin(shard).get_docs(vocab)
+
+
+class _SpanIndexBuilder:
+    """
+    Collects the columns of a SpanIndex doc by doc
+    in compact arrays instead of Python lists.
+    """
+    def __init__(self, spans_key: Optional[str] = None):
+        self.spans_key = spans_key
+        self.labels: Dict[str, int] = {}
+        self.doc_id = array.array("i")
+        self.start = array.array("i")
+        self.end = array.array("i")
+        self.label = array.array("i")
+        self.text_hash = array.array("Q")
+        self.doc_length = array.array("i")
+
+    def add(self, doc: Doc) -> None:
+        i = len(self.doc_length)
+        self.doc_length.append(len(doc))
+        if self.spans_key is None:
+            spans = doc.ents
+        else:
+            spans = doc.spans.get(self.spans_key, [])
+        for span in spans:
+            label = self.labels.setdefault(span.label_, len(self.labels))
+            self.doc_id.append(i)
+            self.start.append(span.start)
+            self.end.append(span.end)
+            self.label.append(label)
+            self.text_hash.append(hash_string(span.text))
+
+    def build(self) -> "SpanIndex":
+        return SpanIndex(
+            doc_id=numpy.frombuffer(self.doc_id, dtype="int32"),
+            start=numpy.frombuffer(self.start, dtype="int32"),
+            end=numpy.frombuffer(self.end, dtype="int32"),
+            label=numpy.frombuffer(self.label, dtype="int32"),
+            text_hash=numpy.frombuffer(self.text_hash, dtype="uint64"),
+            doc_length=numpy.frombuffer(self.doc_length, dtype="int32"),
+            labels=list(self.labels),
+            spans_key=self.spans_key
+        )
+
+
+def _compact(values: numpy.ndarray) -> numpy.ndarray:
+    """'values' in the smallest signed integer type that holds them."""
+    for dtype in ("int8", "int16", "int32"):
+        info = numpy.iinfo(dtype)
+        if len(values) == 0 or (values.min() >= info.min and values.max() <= info.max):
+            return values.astype(dtype, copy=False)
+    return values
+
+
+def _mmap_npz(path: Path) -> Dict[str, numpy.ndarray]:
+    """
+    Memory-maps the arrays of an uncompressed .npz file, which
+    numpy.load only does for single .npy files. Compressed arrays,
+    as written by SpanIndex.to_disk, are read into memory.
+    """
+    arrays = {}
+    with zipfile.ZipFile(path) as zf, path.open("rb") as f:
+        for member in zf.infolist():
+            name = member.filename[:-len(".npy")]
+            if member.compress_type != zipfile.ZIP_STORED:
+                arrays[name] = numpy.load(zf.open(member), allow_pickle=False)
+                continue
+            # Skip the local file header to get to the .npy data.
+            f.seek(member.header_offset + 26)
+            name_length, extra_length = numpy.frombuffer(f.read(4), dtype="<u2")
+            f.seek(name_length + extra_length, os.SEEK_CUR)
+            if numpy.lib.format.read_magic(f) == (1, 0):
+                header = numpy.lib.format.read_array_header_1_0(f)
+            else:
+                header = numpy.lib.format.read_array_header_2_0(f)
+            shape, fortran, dtype = header
+            if dtype.hasobject:
+                arrays[name] = numpy.load(zf.open(member), allow_pickle=False)
+            elif 0 in shape:
+                arrays[name] = numpy.empty(shape, dtype=dtype)
+            else:
+                arrays[name] = numpy.memmap(
+                    path, dtype=dtype, mode="r", offset=f.tell(),
+                    shape=shape, order="F" if fortran else "C"
+                )
+    return arrays
+
+
+@dataclass
+class SpanIndex:
+    """
+    Columnar index of the spans in a corpus, stored
+    as a .spans.npz sidecar next to the .spacy file.
+    Each span has an entry in 'doc_id', 'start', 'end',
+    'label' (an index into 'labels') and 'text_hash'
+    (the spaCy hash of the span text), and 'doc_length'
+    has the number of tokens of each doc. Spans are
+    read from Doc.spans['spans_key'] or from Doc.ents
+    if 'spans_key' is None. This is enough for statistics
+    and span lookups without a Vocab or Doc objects.
+    """
+    doc_id: numpy.ndarray
+    start: numpy.ndarray
+    end: numpy.ndarray
+    label: numpy.ndarray
+    text_hash: numpy.ndarray
+    doc_length: numpy.ndarray
+    labels: List[str]
+    spans_key: Optional[str] = None
+
+    def __len__(self) -> int:
+        return len(self.doc_id)
+
+    @property
+    def n_docs(self) -> int:
+        return len(self.doc_length)
+
+    @property
+    def length(self) -> numpy.ndarray:
+        return self.end - self.start
+
+    @classmethod
+    def builder(cls, spans_key: Optional[str] = None) -> _SpanIndexBuilder:
+        return _SpanIndexBuilder(spans_key)
+
+    @classmethod
+    def from_docs(
+        cls, docs: Iterable[Doc], spans_key: Optional[str] = None
+    ) -> "SpanIndex":
+        builder = cls.builder(spans_key)
+        for doc in docs:
+            builder.add(doc)
+        return builder.build()
+
+    def select(self, doc_ids: Sequence[int]) -> "SpanIndex":
+        """
+        Returns the index of the corpus made of the docs
+        'doc_ids' in this order, like _util.select_docs.
+        """
+        doc_ids = numpy.asarray(doc_ids, dtype="int64")
+        new_ids = numpy.full(self.n_docs, -1, dtype="int64")
+        new_ids[doc_ids] = numpy.arange(len(doc_ids))
+        span_ids = new_ids[self.doc_id]
+        rows = numpy.flatnonzero(span_ids >= 0)
+        rows = rows[numpy.argsort(span_ids[rows], kind="stable")]
+        # Renumber the labels in order of appearance like the builder.
+        used, first = numpy.unique(self.label[rows], return_index=True)
+        used = used[numpy.argsort(first)]
+        new_labels = numpy.zeros(len(self.labels), dtype="int32")
+        new_labels[used] = numpy.arange(len(used))
+        return SpanIndex(
+            doc_id=span_ids[rows],
+            start=self.start[rows],
+            end=self.end[rows],
+            label=new_labels[self.label[rows]],
+            text_hash=self.text_hash[rows],
+            doc_length=self.doc_length[doc_ids],
+            labels=[self.labels[i] for i in used],
+            spans_key=self.spans_key
+        )
+
+    def to_disk(self, path: Union[Path, str]) -> None:
+        """
+        Writes the index as a compressed .npz file, with the ids,
+        offsets and lengths in the smallest integer type that holds
+        them, so that it stays smaller than the corpus it indexes.
+        """
+        path = ensure_path(path)
+        numpy.savez_compressed(
+            path,
+            doc_id=_compact(self.doc_id),
+            start=_compact(self.start),
+            end=_compact(self.end),
+            label=_compact(self.label),
+            text_hash=self.text_hash,
+            doc_length=_compact(self.doc_length),
+            labels=numpy.asarray(self.labels, dtype="U"),
+            spans_key=numpy.asarray([] if self.spans_key is None else [self.spans_key], dtype="U")
+        )
+
+    @classmethod
+    def from_disk(cls, path: Union[Path, str], mmap: bool = True) -> "SpanIndex":
+        path = ensure_path(path)
+        if mmap:
+            arrays = _mmap_npz(path)
+        else:
+            arrays = dict(numpy.load(path, allow_pickle=False))
+        spans_key = arrays.pop("spans_key").tolist()
+        labels = arrays.pop("labels").tolist()
+        return cls(
+            labels=labels,
+            spans_key=spans_key[0] if spans_key else None,
+            **arrays
+        )
+
+
+def span_index_path(path: Union[Path, str]) -> Path:
+    path = ensure_path(path)
+    return path.parent / f"{path.name}{SPAN_INDEX_SUFFIX}"
+
+
+def sidecar_paths(path: Union[Path, str]) -> List[Path]:
+    """
+    Returns the paths of the doc index and SpanIndex of a corpus.
+    """
+    path = ensure_path(path)
+    return [_index_path(path), span_index_path(path)]
+
+
+def write_sidecars(
+    path: Union[Path, str], docs: Sequence[Doc], spans_key: Optional[str] = None
+) -> None:
+    """
+    Writes the doc index and SpanIndex of the
+    single .spacy file at 'path' holding 'docs'.
+    """
+    span_index = SpanIndex.from_docs(docs, spans_key)
+    span_index.to_disk(span_index_path(path))
+    write_doc_index(path, [len(docs)], span_index)
+
+
+def load_span_index(
+    path: Union[Path, str], spans_key: Optional[str] = None
+) -> SpanIndex:
+    """
+    Returns the SpanIndex of the corpus at 'path',
+    building it first if it's missing, older than the
+    corpus or was built for another 'spans_key'.
+    """
+    index = cached_span_index(path, spans_key)
+    if index is None:
+        index = SpanIndex.from_docs(LazyDocBin(path).get_docs(Vocab()), spans_key)
+        index.to_disk(span_index_path(path))
+    return index
+
+
+def cached_span_index(
+    path: Union[Path, str], spans_key: Optional[str] = None
+) -> Optional[SpanIndex]:
+    """
+    Returns the SpanIndex sidecar of the corpus at 'path' if it's
+    up to date and was built for 'spans_key', without decoding
+    any Docs, and None otherwise.
+    """
+    path = ensure_path(path)
+    index_path = span_index_path(path)
+    if not index_path.exists():
+        return None
+    mtime = index_path.stat().st_mtime
+    if any(shard.stat().st_mtime > mtime for shard in shard_paths(path)):
+        return None
+    index = SpanIndex.from_disk(index_path)
+    return index if index.spans_key == spans_key else None
+
+
+class DocBinWriter:
+    """
+    Adds docs to a DocBin and writes it to 'output_file' when closed.
+    If 'shard_size' is set 'output_file' is a directory instead and the
+    DocBin is flushed to a new shard in it every 'shard_size' docs,
+    so only one shard is kept in memory at a time. The number of docs,
+    label counts and hash of each shard are written to a sidecar manifest
+    for LazyDocBin and ShardedCorpus, and the spans in
+    Doc.spans['spans_key'] (or Doc.ents if it's None) to a
+    SpanIndex sidecar. The DocBins are written in 'docbin_format'.
+    """
+
+    def __init__(
+        self,
+        output_file: Path,
+        *,
+        shard_size: int = 0,
+        spans_key: Optional[str] = None,
+        docbin_format: DocBinFormat = DocBinFormat(),
+        msg: Printer,
+    ):
+        self.output_file = output_file
+        self.shard_size = shard_size
+        self.docbin_format = docbin_format
+        self.msg = msg
+        self.n_docs = 0
+        self.shard_sizes: List[int] = []
+        self._db = docbin_format.docbin()
+        self._spans = SpanIndex.builder(spans_key)
+        # Clear the output of a previous run in the other mode or with more shards.
+        if output_file.is_dir():
+            shutil.rmtree(output_file)
+        elif shard_size and output_file.exists():
+            output_file.unlink()
+
+    def add(self, doc: Doc) -> None:
+        self._db.add(doc)
+        self._spans.add(doc)
+        self.n_docs += 1
+        if self.shard_size and len(self._db) >= self.shard_size:
+            self._flush()
+
+    def _flush(self) -> None:
+        self.output_file.mkdir(parents=True, exist_ok=True)
+        shard_file = self.output_file / f"{len(self.shard_sizes):04d}.spacy"
+        self.docbin_format.to_disk(self._db, shard_file)
+        self.shard_sizes.append(len(self._db))
+        self._db = self.docbin_format.docbin()
+
+    def close(self) -> None:
+        self.output_file.parent.mkdir(parents=True, exist_ok=True)
+        span_index = self._spans.build()
+        span_index.to_disk(span_index_path(self.output_file))
+        if not self.shard_size:
+            self.docbin_format.to_disk(self._db, self.output_file)
+            write_doc_index(self.output_file, [self.n_docs], span_index)
+            self.msg.good(
+                f"Generated output file ({self.n_docs} documents): {self.output_file}"
+            )
+            return
+        if len(self._db) or not self.shard_sizes:
+            self._flush()
+        write_doc_index(self.output_file, self.shard_sizes, span_index)
+        self.msg.good(
+            f"Generated {len(self.shard_sizes)} output shards "
+            f"({self.n_docs} documents): {self.output_file}"
+        )
+
+
+def transfer_ents_to_spans(
+    docs: Iterable[Doc], spans_key: Union[str, Sequence[str]]
+) -> Iterator[Doc]:
+    spans_keys = [spans_key] if isinstance(spans_key, str) else spans_key
+    for doc in docs:
+        spans = [ent for ent in doc.ents]
+        for key in spans_keys:
+            group = SpanGroup(doc, name=key, spans=spans)
+            doc.spans[key] = group
+        doc.set_ents([])
+        yield doc
+
+
+def corpus_output_path(
+    output_dir: Union[str, Path], input_loc: Path, is_dev: bool, remove_prefix: str = ""
+) -> Path:
+    if is_dev:
+        filename = input_loc.stem + "-dev" + input_loc.suffix
+    else:
+        filename = input_loc.parts[-1]
+    if remove_prefix and filename.startswith(remove_prefix):
+        filename = filename[len(remove_prefix):]
+    output_file = Path(output_dir) / filename
+    return output_file.with_suffix(".spacy")
+
+
+class CorpusWriter:
+    """
+    Writes the docs of one split to the Doc.ents corpus in 'ents_dir',
+    the Doc.spans corpus in 'spans_dir' or both. Each doc is added to the
+    Doc.ents corpus before its entities are moved to Doc.spans, so a
+    single conversion pass can fill both corpora. Without 'transfer'
+    the docs come with their Doc.spans already set.
+    """
+
+    def __init__(
+        self,
+        input_loc: Path,
+        is_dev: bool,
+        *,
+        ents_dir: Optional[Union[str, Path]],
+        spans_dir: Optional[Union[str, Path]],
+        spans_keys: Sequence[str],
+        shard_size: int,
+        remove_prefix: str = "",
+        transfer: bool = True,
+        attrs_profile: str = "auto",
+        compression: str = "zlib",
+        msg: Printer,
+    ):
+        self.spans_keys = spans_keys
+        self.transfer = transfer
+        self.writers = {}
+        outputs = (("ents", ents_dir, None), ("spans", spans_dir, spans_keys[0]))
+        for name, output_dir, spans_key in outputs:
+            if output_dir is not None:
+                output_file = corpus_output_path(output_dir, input_loc, is_dev, remove_prefix)
+                docbin_format = DocBinFormat.from_options(
+                    attrs_profile, compression, spans=spans_key is not None
+                )
+                writer = DocBinWriter(
+                    output_file,
+                    shard_size=shard_size,
+                    spans_key=spans_key,
+                    docbin_format=docbin_format,
+                    msg=msg,
+                )
+                self.writers[name] = writer
+        self.n_docs = 0
+
+    def add(self, doc: Doc) -> None:
+        if "ents" in self.writers:
+            self.writers["ents"].add(doc)
+        if "spans" in self.writers:
+            if self.transfer:
+                (doc,) = transfer_ents_to_spans([doc], self.spans_keys)
+            self.writers["spans"].add(doc)
+        self.n_docs += 1
+
+    def close(self) -> None:
+        for writer in self.writers.values():
+            writer.close()
+
+
+def fold_path(path: Union[Path, str], fold: int) -> Path:
+    path = ensure_path(path)
+    return path.parent / f"{path.name}{FOLD_SUFFIX.format(fold=fold)}"
+
+
+def write_folds(path: Union[Path, str], folds: numpy.ndarray) -> List[Path]:
+    """
+    Writes the ids of the docs of the corpus at 'path' held
+    out in each fold, given the fold of each doc, and removes
+    the files of the folds of a previous run that are gone.
+    """
+    folds = numpy.asarray(folds)
+    n_folds = int(folds.max()) + 1 if len(folds) else 0
+    paths = []
+    for fold in range(n_folds):
+        paths.append(fold_path(path, fold))
+        numpy.save(paths[-1], numpy.flatnonzero(folds == fold))
+    fold = n_folds
+    while fold_path(path, fold).exists():
+        fold_path(path, fold).unlink()
+        fold += 1
+    return paths
+
+
+def read_fold(path: Union[Path, str], fold: int) -> numpy.ndarray:
+    return numpy.load(fold_path(path, fold))
+
+
+class FoldCorpus(Corpus):
+    """
+    spacy.Corpus that reads one fold of a corpus split with
+    write_folds: the docs held out in 'fold' if 'held_out' is
+    True and all other docs if it's False. Only the shards
+    with docs of the fold are loaded, and only the docs of
+    the fold are turned into Docs.
+    """
+
+    def __init__(
+        self, path: Union[str, Path], *, fold: int, held_out: bool = False, **kwargs
+    ):
+        super().__init__(path, **kwargs)
+        self.fold = fold
+        self.held_out = held_out
+
+    def read_docbin(self, vocab: Vocab, locs: Iterable[Union[str, Path]]) -> Iterator[Doc]:
+        corpus = LazyDocBin(self.path)
+        keep = numpy.zeros(len(corpus), dtype=bool)
+        keep[read_fold(self.path, self.fold)] = True
+        if not self.held_out:
+            keep = ~keep
+        i = 0
+        for shard_id, shard in enumerate(corpus.shards):
+            start, end = corpus.offsets[shard_id], corpus.offsets[shard_id + 1]
+            ids = numpy.flatnonzero(keep[start:end])
+            if len(ids) == 0:
+                continue
+            docbin = load_docbin(shard)
+            for doc in select_docs(docbin, ids).get_docs(vocab):
+                if len(doc):
+                    yield doc
+                    i += 1
+                    if self.limit >= 1 and i >= self.limit:
+                        return
+
+
+@registry.readers("span_labeling.FoldCorpus.v1")
+def create_fold_reader(
+    path: Optional[Path],
+    fold: int,
+    held_out: bool = False,
+    gold_preproc: bool = False,
+    max_length: int = 0,
+    limit: int = 0,
+    augmenter: Optional[Callable] = None,
+    shuffle: bool = False,
+) -> Callable[["Language"], Iterable["Example"]]:
+    """
+    Reader for a fold of a k-fold corpus written by split_docs
+    or toxic_spans with --n-folds. It can replace spacy.Corpus.v1
+    in configs/spancat_default.cfg from the command line:
+
+    python -m spacy train configs/spancat_default.cfg --code scripts/_util.py
+    --paths.train corpus.spacy --paths.dev corpus.spacy
+    --corpora.train.@readers span_labeling.FoldCorpus.v1 --corpora.train.fold 0
+    --corpora.dev.@readers span_labeling.FoldCorpus.v1 --corpora.dev.fold 0
+    --corpora.dev.held_out true
+    """
+    if path is None:
+        raise ValueError("A path is required for the fold corpus")
+    return FoldCorpus(
+        path,
+        fold=fold,
+        held_out=held_out,
+        gold_preproc=gold_preproc,
+        max_length=max_length,
+        limit=limit,
+        augmenter=augmenter,
+        shuffle=shuffle,
+    )
+
+
+class ShardedCorpus(Corpus):
+    """
+    spacy.Corpus that streams a corpus one shard at a time, so
+    only one shard is in memory. With 'shuffle_shards' the shards
+    are read in a new random order on each pass, and with 'shuffle'
+    the docs are shuffled within each shard instead of over the
+    whole corpus like spacy.Corpus does.
+
+    spacy train only streams the training corpus with
+    training.max_epochs = -1. With max_epochs >= 0, like the 1 in
+    configs/spancat_default.cfg, it loads all examples into memory
+    and shuffles them on each epoch, undoing both.
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        *,
+        shuffle_shards: bool = True,
+        seed: Optional[int] = None,
+        shuffle: bool = False,
+        **kwargs,
+    ):
+        super().__init__(path, shuffle=False, **kwargs)
+        self.shuffle_shards = shuffle_shards
+        self.shuffle_docs = shuffle
+        self._rng = random.Random(seed)
+
+    def read_docbin(self, vocab: Vocab, locs: Iterable[Union[str, Path]]) -> Iterator[Doc]:
+        shards = shard_paths(self.path)
+        if self.shuffle_shards:
+            self._rng.shuffle(shards)
+        i = 0
+        for shard in shards:
+            docs: Iterable[Doc] = load_docbin(shard).get_docs(vocab)
+            if self.shuffle_docs:
+                docs = list(docs)
+                self._rng.shuffle(docs)
+            for doc in docs:
+                if len(doc):
+                    yield doc
+                    i += 1
+                    if self.limit >= 1 and i >= self.limit:
+                        return
+
+
+@registry.readers("span_labeling.ShardedCorpus.v1")
+def create_sharded_reader(
+    path: Optional[Path],
+    shuffle_shards: bool = True,
+    seed: Optional[int] = None,
+    gold_preproc: bool = False,
+    max_length: int = 0,
+    limit: int = 0,
+    augmenter: Optional[Callable] = None,
+    shuffle: bool = False,
+) -> Callable[["Language"], Iterable["Example"]]:
+    """
+    Streaming reader for the corpora in corpus/, sharded with
+    --shard-size or single .spacy files. It can replace
+    spacy.Corpus.v1 in configs/spancat_default.cfg from the
+    command line. --training.max_epochs -1 is required, or spacy
+    train loads the whole corpus and shuffles it; the training
+    then ends after training.max_steps or training.patience:
+
+    python -m spacy train configs/spancat_default.cfg --code scripts/_util.py
+    --paths.train corpus/spancat/wnut17-train.spacy
+    --paths.dev corpus/spancat/wnut17-dev.spacy
+    --corpora.train.@readers span_labeling.ShardedCorpus.v1
+    --training.max_epochs -1
+    """
+    if path is None:
+        raise ValueError("A path is required for the sharded corpus")
+    return ShardedCorpus(
+        path,
+        shuffle_shards=shuffle_shards,
+        seed=seed,
+        gold_preproc=gold_preproc,
+        max_length=max_length,
+        limit=limit,
+        augmenter=augmenter,
+        shuffle=shuffle,
+    )
+
+
+def model_path(model: str) -> Path:
+    """
+    Returns the directory of a pipeline given either
+    its path or the name of an installed package.
+    """
+    path = ensure_path(model)
+    if path.exists():
+        return path
+    if not is_package(model):
+        raise IOError(f"Can't find pipeline '{model}'")
+    package_path = get_package_path(model)
+    meta = get_model_meta(package_path)
+    return package_path / f"{meta['lang']}_{meta['name']}-{meta['version']}"
+
+
+@dataclass
+class VectorKeys:
+    """
+    The sorted ORTH hashes that have a row in the vectors
+    table of a pipeline, read without loading the vectors
+    themselves or the rest of the pipeline. With "floret"
+    vectors every token has a vector.
+    """
+    keys: numpy.ndarray
+    mode: str = "default"
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    @classmethod
+    def from_model(cls, model: str) -> "VectorKeys":
+        vocab_path = model_path(model) / "vocab"
+        cfg_path = vocab_path / "vectors.cfg"
+        cfg = srsly.read_json(cfg_path) if cfg_path.exists() else {}
+        key2row_path = vocab_path / "key2row"
+        keys_path = vocab_path / "keys"
+        if key2row_path.exists():
+            key2row = srsly.read_msgpack(key2row_path)
+            keys = numpy.fromiter(key2row.keys(), dtype="uint64", count=len(key2row))
+        elif keys_path.exists():
+            keys = numpy.load(keys_path).astype("uint64")
+        else:
+            keys = numpy.zeros((0,), dtype="uint64")
+        return cls(numpy.unique(keys), cfg.get("mode", "default"))
+
+    def contains(self, hashes: numpy.ndarray) -> numpy.ndarray:
+        """
+        Boolean mask of the 'hashes' that have a vector.
+        """
+        hashes = numpy.asarray(hashes, dtype="uint64")
+        if self.mode == "floret":
+            return numpy.ones(hashes.shape, dtype=bool)
+        if len(self.keys) == 0:
+            return numpy.zeros(hashes.shape, dtype=bool)
+        idx = numpy.searchsorted(self.keys, hashes)
+        idx[idx == len(self.keys)] = 0
+        return self.keys[idx] == hashes
+
 
 @dataclass
 class DatasetInfo:
@@ -89,11 +1175,94 @@ class DatasetInfo:
     def __getitem__(self, key: str) -> SplitInfo:
         return self.__dict__[key]
 
-    def load(self) -> Tuple[DocBin, DocBin, DocBin]:
-        train = DocBin().from_disk(self.train.path)
-        dev = DocBin().from_disk(self.dev.path)
-        test = DocBin().from_disk(self.test.path)
-        return train, dev, test
+    @property
+    def n_tokens(self) -> int:
+        """The number of tokens of all splits, 0 if unknown."""
+        return sum(split.n_tokens or 0 for split in (self.train, self.dev, self.test))
+
+    def load(self) -> Tuple["LazyDocBin", "LazyDocBin", "LazyDocBin"]:
+        """
+        Returns the splits as LazyDocBins, which
+        only deserialize the docs when they are used.
+        """
+        return self.train.load(), self.dev.load(), self.test.load()
+
+
+def _corpus_stat(path: Union[Path, str]) -> Dict:
+    stats = [shard.stat() for shard in shard_paths(path)]
+    return {
+        "size": sum(stat.st_size for stat in stats),
+        "mtime": max((stat.st_mtime for stat in stats), default=0.0),
+        "n_shards": len(stats),
+    }
+
+
+def stored_spans_key(
+    path: Union[Path, str], manifest: Optional[Dict] = None
+) -> Optional[str]:
+    """
+    The spans key of the corpus from its manifest or else
+    its SpanIndex, so the SpanIndex isn't rebuilt for Doc.ents.
+    """
+    path = ensure_path(path)
+    if manifest is None:
+        manifest = read_manifest(path)
+    if manifest.get("spans_key") is not None:
+        return manifest["spans_key"]
+    index_path = span_index_path(path)
+    if index_path.exists():
+        return SpanIndex.from_disk(index_path).spans_key
+    return None
+
+
+def catalog_entry(path: Union[Path, str]) -> Dict:
+    """
+    The catalog entry of the corpus at 'path', read from its
+    manifest and SpanIndex sidecars without loading any Docs.
+    """
+    path = ensure_path(path)
+    manifest = read_manifest(path)
+    span_index = load_span_index(path, stored_spans_key(path, manifest))
+    hasher = hashlib.blake2b(digest_size=16)
+    for shard in manifest["shards"]:
+        hasher.update(shard["hash"].encode("utf8"))
+    counts = numpy.bincount(span_index.label, minlength=len(span_index.labels))
+    return {
+        "path": str(path),
+        **_corpus_stat(path),
+        "hash": hasher.hexdigest(),
+        "n_docs": sum(shard["n_docs"] for shard in manifest["shards"]),
+        "n_tokens": int(span_index.doc_length.sum()),
+        "labels": {label: int(count) for label, count in zip(span_index.labels, counts)},
+        "spans_key": span_index.spans_key,
+    }
+
+
+def read_catalog(home: Union[Path, str] = "corpus") -> Dict:
+    """
+    Returns the catalog of the corpora in 'home', with the
+    catalog_entry of each split by "{model}/{name}".
+    """
+    catalog_path = ensure_path(home) / CATALOG_NAME
+    if not catalog_path.exists():
+        return {"splits": {}}
+    with catalog_path.open(encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_catalog(home: Union[Path, str], catalog: Dict) -> None:
+    """
+    Writes the catalog of 'home' through a temporary file,
+    and not at all if 'home' isn't writable.
+    """
+    catalog_path = ensure_path(home) / CATALOG_NAME
+    tmp_path = catalog_path.parent / f".{CATALOG_NAME}.tmp"
+    try:
+        with tmp_path.open("w", encoding="utf-8") as f:
+            json.dump(catalog, f, indent=1)
+        os.replace(tmp_path, catalog_path)
+    except OSError:
+        pass
 
 
 def info(model: str, *, home: str = "corpus") -> Dict[str, DatasetInfo]:
@@ -102,19 +1271,42 @@ def info(model: str, *, home: str = "corpus") -> Dict[str, DatasetInfo]:
     parsing the filenames. It's also useful to
     validate that all splits are there and the
     filenames are in the standardized format.
+
+    The sizes, doc and token counts and labels of the
+    splits come from the catalog in 'home', and only
+    the entries of splits that changed are rebuilt.
     """
     if model not in ["ner", "spancat"]:
         raise ValueError(
             "'model' has to be 'ner' or 'spancat', "
             f"but found {model}"
         )
+    catalog = read_catalog(home)
     home = os.path.join(home, model)
-    filenames = os.listdir(home)
-    splits = []
-    for name in filenames:
-        path = os.path.join(home, name)
-        split = SplitInfo(path)
-        splits.append(split)
+    # Skip sidecar files like the doc indices.
+    filenames = sorted(name for name in os.listdir(home) if name.endswith(".spacy"))
+    splits = [SplitInfo(os.path.join(home, name)) for name in filenames]
+    entries = catalog["splits"]
+    keys = set()
+    stale = False
+    for split in splits:
+        key = f"{model}/{split.name}"
+        keys.add(key)
+        entry = entries.get(key)
+        stat = _corpus_stat(split.path)
+        if entry is None or any(entry.get(k) != value for k, value in stat.items()):
+            entry = entries[key] = catalog_entry(split.path)
+            stale = True
+        split.size = entry["size"]
+        split.hash = entry["hash"]
+        split.n_docs = entry["n_docs"]
+        split.n_tokens = entry["n_tokens"]
+        split.labels = entry["labels"]
+    for key in [key for key in entries if key.startswith(f"{model}/") and key not in keys]:
+        del entries[key]
+        stale = True
+    if stale:
+        write_catalog(os.path.dirname(home), catalog)
     datasets: Dict[str, Dict[str, SplitInfo]] = defaultdict(dict)
     for split in splits:
         datasets[split.source][split.split] = split
@@ -132,3 +1324,94 @@ def info(model: str, *, home: str = "corpus") -> Dict[str, DatasetInfo]:
         )
         out[source] = datainfo
     return out
+
+
+def _update_hash(hasher, path: Path) -> None:
+    if path.is_dir():
+        for child in sorted(path.iterdir()):
+            hasher.update(child.name.encode("utf8"))
+            _update_hash(hasher, child)
+        return
+    with path.open("rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            hasher.update(block)
+
+
+def _copy(src: Path, dest: Path) -> None:
+    if dest.is_dir():
+        shutil.rmtree(dest)
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    if src.is_dir():
+        shutil.copytree(src, dest)
+    else:
+        shutil.copy2(src, dest)
+
+
+def _size(path: Path) -> int:
+    if path.is_dir():
+        return sum(_size(child) for child in path.iterdir())
+    return path.stat().st_size
+
+
+class OutputCache:
+    """
+    On-disk cache for the output files of a command.
+    Entries are keyed by a hash of the contents of
+    the input files and the options of the command,
+    so an unchanged input is served from the cache
+    even if other inputs of the same command changed.
+    When the cache grows beyond 'max_size' GB the least
+    recently used entries are removed.
+    """
+    def __init__(self, cache_dir: Union[Path, str], max_size: float = CACHE_SIZE):
+        self.cache_dir = ensure_path(cache_dir)
+        self.max_size = max_size
+
+    def key(self, inputs: Iterable[Union[Path, str]], **options) -> str:
+        hasher = hashlib.sha256()
+        for path in inputs:
+            _update_hash(hasher, ensure_path(path))
+        options_str = json.dumps(options, sort_keys=True, default=str)
+        hasher.update(options_str.encode("utf8"))
+        return hasher.hexdigest()
+
+    def restore(self, key: str, outputs: Sequence[Path]) -> bool:
+        """
+        Copies the cached outputs for 'key' to 'outputs'
+        and returns whether they were found.
+        """
+        entry = self.cache_dir / key
+        cached = [entry / f"{i}-{path.name}" for i, path in enumerate(outputs)]
+        if not all(path.exists() for path in cached):
+            return False
+        for src, dest in zip(cached, outputs):
+            _copy(src, dest)
+        # The modification time of an entry marks its last use.
+        os.utime(entry)
+        return True
+
+    def store(self, key: str, outputs: Sequence[Path]) -> None:
+        entry = self.cache_dir / key
+        tmp = self.cache_dir / f"{key}.tmp"
+        if tmp.exists():
+            shutil.rmtree(tmp)
+        for i, path in enumerate(outputs):
+            _copy(path, tmp / f"{i}-{path.name}")
+        if entry.exists():
+            shutil.rmtree(entry)
+        tmp.rename(entry)
+        self._evict()
+
+    def _evict(self) -> None:
+        entries = [
+            path for path in self.cache_dir.iterdir()
+            if path.is_dir() and path.suffix != ".tmp"
+        ]
+        entries.sort(key=lambda path: path.stat().st_mtime)
+        sizes = [_size(path) for path in entries]
+        total = sum(sizes)
+        for path, size in zip(entries, sizes):
+            if total <= self.max_size * 1024 ** 3:
+                break
+            shutil.rmtree(path)
+            total -= size
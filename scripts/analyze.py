@@ -2,100 +2,205 @@ import os
 import csv
 import tqdm
 
+import numpy
 import spacy
 import typer
 import pandas as pd
 
 from wasabi import msg
-from spacy.tokens import Doc, DocBin
-from typing import Sequence, List, Union, Dict
-from _util import SplitInfo
+from spacy.attrs import ORTH, NORM, PREFIX, SUFFIX, SHAPE
+from spacy.tokens import Doc
+from spacy.vocab import Vocab
+from spacy.util import get_model_meta, minibatch
+from typing import Iterable, Optional, Tuple, Union, Dict
+from _util import SplitInfo, LazyDocBin, VectorKeys, model_path
 
 Number = Union[int, float]
 
+# Token attributes collected for the vocabulary statistics.
+TOKEN_ATTRS = [ORTH, NORM, PREFIX, SUFFIX, SHAPE]
+BATCH_SIZE = 1000
 
-def per_ent_stats(docs: Sequence[Doc]) -> List[Dict]:
-    spans = []
-    for i, doc in tqdm.tqdm(enumerate(docs), total=len(docs)):
-        # Special "null span" row.
-        if not doc.ents:
-            row = {
-                "doc_id": i,
-                "text": None,
-                "label": None,
-                "length": None,
-                "doc_length": len(doc),
-                "num_ents": 0
-            }
-            spans.append(row)
-        for span in doc.ents:
-            row = {
-                "doc_id": i,
-                "text": span.text,
-                "label": span.label_,
-                "length": len(span),
-                "doc_length": len(doc),
-                "num_ents": len(doc.ents)
-            }
-            spans.append(row)
-    return spans
-
-
-def datastats(df: pd.DataFrame):
-    doc_group = df.groupby(["doc_id"])
-    msg.info(f"Num docs {len(doc_group)}")
-    msg.info(f"Number of classes {df['label'].nunique()}")
-    msg.info(f"Average doc-length: {doc_group['doc_length'].mean().mean()}")
-    msg.info(f"Average number of entities: {doc_group['num_ents'].mean().mean()}")
-    msg.info(f"Average document length: {doc_group['doc_length'].mean().mean()}")
-    msg.info(f"Average entity length: {df['length'].mean()}")
-    msg.info(f"Total number of entities: {len(df[df['label'].notnull()])}")
 
+def collect(
+    docs: Iterable[Doc],
+    *,
+    spans_key: Optional[str] = None,
+    total: Optional[int] = None,
+    batch_size: int = BATCH_SIZE
+) -> Dict[str, numpy.ndarray]:
+    """
+    Collects the TOKEN_ATTRS of all tokens with Doc.to_array
+    a batch of docs at a time, and the doc id, offsets, label
+    and text of all spans in Doc.spans[spans_key], or in
+    Doc.ents if 'spans_key' is None.
+    """
+    tokens = []
+    doc_length = []
+    span_doc_id = []
+    span_start = []
+    span_end = []
+    span_label = []
+    span_text = []
+    i = 0
+    progress = tqdm.tqdm(total=total, disable=msg.no_print)
+    for batch in minibatch(docs, size=batch_size):
+        arrays = []
+        for doc in batch:
+            arrays.append(doc.to_array(TOKEN_ATTRS))
+            doc_length.append(len(doc))
+            spans = doc.ents if spans_key is None else doc.spans.get(spans_key, [])
+            for span in spans:
+                span_doc_id.append(i)
+                span_start.append(span.start)
+                span_end.append(span.end)
+                span_label.append(span.label_)
+                span_text.append(span.text)
+            i += 1
+        if arrays:
+            tokens.append(numpy.concatenate(arrays))
+        progress.update(len(batch))
+    progress.close()
+    empty = numpy.zeros((0, len(TOKEN_ATTRS)), dtype="uint64")
+    return {
+        "tokens": numpy.concatenate(tokens) if tokens else empty,
+        "doc_length": numpy.asarray(doc_length, dtype="int64"),
+        "span_doc_id": numpy.asarray(span_doc_id, dtype="int64"),
+        "span_length": numpy.asarray(span_end, dtype="int64") - numpy.asarray(span_start, dtype="int64"),
+        "span_label": numpy.asarray(span_label, dtype=object),
+        "span_text": numpy.asarray(span_text, dtype=object),
+    }
 
-def analyze(
+
+def per_ent_stats(collected: Dict[str, numpy.ndarray]) -> pd.DataFrame:
+    """
+    One row per span with its doc id, text, label, length,
+    the length of its doc and the number of spans in it, plus
+    a "null span" row for each doc without spans.
+    """
+    doc_length = collected["doc_length"]
+    doc_id = collected["span_doc_id"]
+    num_ents = numpy.bincount(doc_id, minlength=len(doc_length))
+    spans = pd.DataFrame({
+        "doc_id": doc_id,
+        "text": collected["span_text"],
+        "label": collected["span_label"],
+        "length": collected["span_length"],
+        "doc_length": doc_length[doc_id],
+        "num_ents": num_ents[doc_id]
+    })
+    # Special "null span" rows.
+    empty = numpy.flatnonzero(num_ents == 0)
+    null_spans = pd.DataFrame({
+        "doc_id": empty,
+        "text": None,
+        "label": None,
+        "length": numpy.nan,
+        "doc_length": doc_length[empty],
+        "num_ents": 0
+    })
+    df = pd.concat([spans, null_spans], ignore_index=True)
+    df = df.sort_values("doc_id", kind="stable", ignore_index=True)
+    return df
+
+
+def datastats(collected: Dict[str, numpy.ndarray]) -> Dict[str, Number]:
+    doc_length = collected["doc_length"]
+    num_ents = numpy.bincount(collected["span_doc_id"], minlength=len(doc_length))
+    stats = {
+        "docs": len(doc_length),
+        "classes": len(numpy.unique(collected["span_label"])),
+        "avg_doc_length": doc_length.mean(),
+        "avg_ents": num_ents.mean(),
+        "avg_ent_length": collected["span_length"].mean(),
+        "ents": len(collected["span_doc_id"]),
+    }
+    msg.info(f"Num docs {stats['docs']}")
+    msg.info(f"Number of classes {stats['classes']}")
+    msg.info(f"Average doc-length: {stats['avg_doc_length']}")
+    msg.info(f"Average number of entities: {stats['avg_ents']}")
+    msg.info(f"Average document length: {stats['avg_doc_length']}")
+    msg.info(f"Average entity length: {stats['avg_ent_length']}")
+    msg.info(f"Total number of entities: {stats['ents']}")
+    return stats
+
+
+def load_vocab(model: str) -> Tuple[Vocab, VectorKeys]:
+    """
+    Returns a Vocab of the language of 'model' with its lookup
+    tables, like lexeme_norm which sets the NORM of the tokens,
+    and the keys of its vectors, without loading the pipeline
+    or the vectors table.
+    """
+    path = model_path(model)
+    meta = get_model_meta(path)
+    vocab = spacy.blank(meta["lang"]).vocab
+    vocab.from_disk(path / "vocab", exclude=["strings", "vectors"])
+    return vocab, VectorKeys.from_model(model)
+
+
+def vector_coverage(
+    orths: numpy.ndarray, vectors: VectorKeys
+) -> Dict[str, Number]:
+    """
+    Number of word types without a vector and the share of
+    types and of tokens that have one, from the ORTH hashes
+    of all tokens in the corpus.
+    """
+    types, counts = numpy.unique(orths, return_counts=True)
+    found = vectors.contains(types)
+    return {
+        "unknown": int(len(types) - found.sum()),
+        "type_coverage": found.mean() if len(types) else 0.0,
+        "token_coverage": counts[found].sum() / counts.sum() if len(types) else 0.0,
+    }
+
+
+def analyze_split(
     docbin_path: str,
-    model: str,
+    vocab: Vocab,
+    vectors: VectorKeys,
     *,
-    data_dir: str = "corpus",
-    output_dir: str = "analyses"
-):
+    output_dir: str = "analyses",
+    spans_key: Optional[str] = None
+) -> Dict[str, Number]:
     """
-    Write two .csv files one with label statistics
-    and another with properties of each entity in
-    the data set.
+    Writes the statistics of a single split with an
+    already loaded 'vocab' and returns the summary
+    numbers of the split.
     """
-    nlp = spacy.load(model)
-    vocab = nlp.vocab
-    docs = list(
-        DocBin().from_disk(docbin_path).get_docs(vocab)
+    docbin = LazyDocBin(docbin_path)
+    collected = collect(
+        docbin.get_docs(vocab), spans_key=spans_key, total=len(docbin)
     )
     splitinfo = SplitInfo(docbin_path)
-    span_stats = per_ent_stats(docs)
-    df = pd.DataFrame.from_dict(span_stats)
-    datastats(df)
-    vocabulary = set()
-    norms = set()
-    prefixes = set()
-    suffixes = set()
-    shapes = set()
-    num_tokens = 0
-    for doc in docs:
-        for token in doc:
-            vocabulary.add(token.text)
-            norms.add(token.norm_)
-            prefixes.add(token.prefix_)
-            suffixes.add(token.suffix_)
-            shapes.add(token.shape_)
-            num_tokens += 1
-    vec_vocabulary = {nlp.vocab.strings[k] for k in nlp.vocab.vectors.keys()}
-    msg.info(f"Vocabulary size: {len(vocabulary)}")
-    msg.info(f"Unknown words: {len(vocabulary - vec_vocabulary)}")
-    msg.info(f"Number of norms: {len(norms)}")
-    msg.info(f"Number of prefixes: {len(prefixes)}")
-    msg.info(f"Number of suffixes: {len(suffixes)}")
-    msg.info(f"Number of shapes: {len(shapes)}")
-    msg.info(f"Number of tokens: {num_tokens}")
-    f_prefix = (f"{splitinfo.dataset}-{splitinfo.split}")
+    df = per_ent_stats(collected)
+    stats = datastats(collected)
+    # Unique hashes per attribute, only the uniques are turned into strings.
+    uniques = [
+        {vocab.strings[int(key)] for key in numpy.unique(column)}
+        for column in collected["tokens"].T
+    ]
+    vocabulary, norms, prefixes, suffixes, shapes = uniques
+    stats["vocab"] = len(vocabulary)
+    stats.update(vector_coverage(collected["tokens"][:, 0], vectors))
+    stats["norms"] = len(norms)
+    stats["prefixes"] = len(prefixes)
+    stats["suffixes"] = len(suffixes)
+    stats["shapes"] = len(shapes)
+    stats["tokens"] = len(collected["tokens"])
+    msg.info(f"Vocabulary size: {stats['vocab']}")
+    msg.info(f"Unknown words: {stats['unknown']}")
+    msg.info(f"Vector coverage of words: {stats['type_coverage']}")
+    msg.info(f"Vector coverage of tokens: {stats['token_coverage']}")
+    msg.info(f"Number of norms: {stats['norms']}")
+    msg.info(f"Number of prefixes: {stats['prefixes']}")
+    msg.info(f"Number of suffixes: {stats['suffixes']}")
+    msg.info(f"Number of shapes: {stats['shapes']}")
+    msg.info(f"Number of tokens: {stats['tokens']}")
+    # The source includes the language, so that the languages of one
+    # dataset like es-conll and nl-conll don't overwrite each other.
+    f_prefix = (f"{splitinfo.source}-{splitinfo.split}")
     if splitinfo.seen != "":
         f_prefix += f"-{splitinfo.seen}"
     span_stats_path = os.path.join(output_dir, f"{f_prefix}.csv")
@@ -115,6 +220,32 @@ def analyze(
         suffixfile.write("\n".join(suffixes))
     with open(shape_path, "w", encoding="utf-8") as shapefile:
         shapefile.write("\n".join(shapes))
+    return stats
+
+
+def analyze(
+    docbin_path: str,
+    model: str,
+    *,
+    data_dir: str = "corpus",
+    output_dir: str = "analyses",
+    spans_key: Optional[str] = None
+):
+    """
+    Write two .csv files one with label statistics
+    and another with properties of each entity in
+    the data set. The entities are read from
+    Doc.spans[spans_key], or Doc.ents if no
+    'spans_key' is given.
+    """
+    vocab, vectors = load_vocab(model)
+    analyze_split(
+        docbin_path,
+        vocab,
+        vectors,
+        output_dir=output_dir,
+        spans_key=spans_key
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,106 @@
+import os
+
+import typer
+import pandas as pd
+
+from pathlib import Path
+from multiprocessing import Pool
+from typing import Any, Dict, Optional, Tuple
+
+from wasabi import msg
+from spacy.vocab import Vocab
+from analyze import analyze_split, load_vocab
+from _util import info, SplitInfo, VectorKeys
+
+SPLITS = ("train", "dev", "test")
+COLUMNS = ["source", "dataset", "lang", "split"]
+# Numbers shown in the summary table, the .csv has all of them.
+TABLE_COLUMNS = COLUMNS + ["docs", "tokens", "ents", "classes", "unknown", "token_coverage"]
+
+# Set once per worker, so the vocab is not sent along with every task.
+_worker_state: Dict[str, Any] = {}
+
+
+def _init_worker(
+    vocab: Vocab,
+    vectors: VectorKeys,
+    output_dir: str,
+    spans_key: Optional[str],
+    silent: bool
+):
+    _worker_state["vocab"] = vocab
+    _worker_state["vectors"] = vectors
+    _worker_state["output_dir"] = output_dir
+    _worker_state["spans_key"] = spans_key
+    msg.no_print = silent
+
+
+def _analyze_worker(split: SplitInfo) -> Dict[str, Any]:
+    stats = analyze_split(
+        str(split.path),
+        _worker_state["vocab"],
+        _worker_state["vectors"],
+        output_dir=_worker_state["output_dir"],
+        spans_key=_worker_state["spans_key"]
+    )
+    row = {
+        "source": split.source,
+        "dataset": split.dataset,
+        "lang": split.lang,
+        "split": split.split,
+    }
+    row.update(stats)
+    return row
+
+
+def analyze_all(
+    # fmt: off
+    model: str = typer.Argument(..., help="Pipeline or vectors package to take the vocabulary and vectors from"),
+    corpus: str = typer.Argument("ner", help="Which corpus to analyze: 'ner' or 'spancat'"),
+    data_dir: Path = typer.Option("corpus", "--data-dir", "-d", help="Directory with the 'ner' and 'spancat' corpora"),
+    output_dir: Path = typer.Option("analyses", "--output-dir", "-o", help="Output directory for the per split and summary statistics"),
+    spans_key: Optional[str] = typer.Option(None, "--spans-key", "-sk", help="Key of the spans to analyze, Doc.ents are used if not given"),
+    n_process: int = typer.Option(1, "--n-process", "-np", help="Number of processes analyzing the splits"),
+    # fmt: on
+):
+    """
+    Analyzes every split of every dataset found by
+    _util.info and writes the summary numbers of all
+    of them to a single "{corpus}-summary.csv". The
+    vocabulary is loaded only once and shared with
+    the worker processes, only the vectors' keys
+    are read and not the pipeline.
+    """
+    datasets = info(corpus, home=str(data_dir))
+    splits = [dataset[name] for dataset in datasets.values() for name in SPLITS]
+    os.makedirs(output_dir, exist_ok=True)
+    vocab, vectors = load_vocab(model)
+    initargs: Tuple = (vocab, vectors, str(output_dir), spans_key)
+    msg.info(f"Analyzing {len(splits)} splits of {len(datasets)} datasets")
+    if n_process > 1:
+        # Largest splits first by the catalog's token counts,
+        # so the last tasks are the short ones.
+        splits.sort(key=lambda split: split.n_tokens, reverse=True)
+        with Pool(n_process, _init_worker, initargs + (True,)) as pool:
+            rows = []
+            for row in pool.imap_unordered(_analyze_worker, splits):
+                msg.good(f"Analyzed {row['source']}-{row['split']}")
+                rows.append(row)
+    else:
+        _init_worker(*initargs, False)
+        rows = [_analyze_worker(split) for split in splits]
+    df = pd.DataFrame(rows)
+    df["split"] = pd.Categorical(df["split"], categories=SPLITS, ordered=True)
+    df = df.sort_values(["source", "split"], ignore_index=True)
+    summary_path = output_dir / f"{corpus}-summary.csv"
+    df.to_csv(summary_path, index=False)
+    msg.table(
+        df[TABLE_COLUMNS].values.tolist(),
+        header=TABLE_COLUMNS,
+        divider=True
+    )
+    msg.good(f"Saved the summary to {summary_path}")
+
+
+if __name__ == "__main__":
+    typer.run(analyze_all)
@@ -0,0 +1,149 @@
+import os
+
+import numpy
+import typer
+import pandas as pd
+
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from wasabi import msg
+from _util import info, load_span_index, SpanIndex
+
+SPLITS = ("train", "dev", "test")
+# Percentiles of the span lengths in the summary.
+PERCENTILES = (50, 90, 99)
+
+
+def length_histogram(index: SpanIndex, max_length: int) -> numpy.ndarray:
+    """
+    The number of spans of each label (rows) by length (columns),
+    with the spans longer than 'max_length' in the last column.
+    """
+    lengths = numpy.minimum(index.length, max_length + 1)
+    n_labels = len(index.labels)
+    counts = numpy.bincount(
+        index.label.astype("int64") * (max_length + 2) + lengths,
+        minlength=n_labels * (max_length + 2),
+    )
+    return counts.reshape(n_labels, max_length + 2)
+
+
+def ngram_candidates(doc_length: numpy.ndarray, max_size: int) -> numpy.ndarray:
+    """
+    The number of candidates the n-gram suggester with the sizes
+    1..max_size proposes for docs of 'doc_length' tokens: each
+    n-gram size n <= length adds length - n + 1 candidates.
+    """
+    length = doc_length.astype("int64")
+    m = numpy.minimum(length, max_size)
+    return m * length - m * (m - 1) // 2
+
+
+def analyze_suggester_split(
+    index: SpanIndex, max_sizes: List[int], batch_words: int
+) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    Returns a row per label with the distribution of the span
+    lengths and the recall of the n-gram suggester for each of
+    'max_sizes', and a row per max size with the recall over all
+    spans and the number of candidates per doc and per batch of
+    'batch_words' tokens.
+    """
+    max_size = max(max_sizes)
+    histogram = length_histogram(index, max_size)
+    covered = numpy.cumsum(histogram, axis=1)
+    n_spans = histogram.sum(axis=1)
+    label_rows = []
+    for label_id, label in enumerate(index.labels):
+        lengths = index.length[index.label == label_id]
+        row: Dict[str, Any] = {
+            "label": label,
+            "spans": int(n_spans[label_id]),
+            "mean_length": float(lengths.mean()),
+        }
+        for q, value in zip(PERCENTILES, numpy.percentile(lengths, PERCENTILES)):
+            row[f"p{q}_length"] = float(value)
+        row["max_length"] = int(lengths.max())
+        for size in max_sizes:
+            row[f"recall@{size}"] = float(covered[label_id, size] / n_spans[label_id])
+        label_rows.append(row)
+    n_tokens = int(index.doc_length.sum())
+    all_covered = covered.sum(axis=0)
+    size_rows = []
+    for size in max_sizes:
+        candidates = ngram_candidates(index.doc_length, size)
+        total = int(candidates.sum())
+        size_rows.append({
+            "max_size": size,
+            "recall": float(all_covered[size] / max(len(index), 1)),
+            "candidates_per_doc": total / max(index.n_docs, 1),
+            "max_candidates_per_doc": int(candidates.max()) if len(candidates) else 0,
+            "candidates_per_batch": total / max(n_tokens, 1) * batch_words,
+            "candidates_per_span": total / max(len(index), 1),
+        })
+    return label_rows, size_rows
+
+
+def analyze_suggester(
+    # fmt: off
+    data_dir: Path = typer.Option("corpus", "--data-dir", "-d", help="Directory with the 'spancat' corpora"),
+    split: str = typer.Option("train", "--split", "-s", help="Split to analyze: 'train', 'dev' or 'test'"),
+    spans_key: str = typer.Option("sc", "--spans-key", "-sk", help="Key of the spans the suggester has to find"),
+    max_size: int = typer.Option(10, "--max-size", "-m", help="Report the suggester with the sizes 1..n for each n up to this one"),
+    batch_words: int = typer.Option(1000, "--batch-words", "-bw", help="Number of tokens per batch, like the batcher size in configs/spancat_default.cfg"),
+    sources: List[str] = typer.Option([], "--source", help="Only analyze these datasets, can be repeated"),
+    output_dir: Optional[Path] = typer.Option(None, "--output-dir", "-o", help="Also write the tables to this directory"),
+    # fmt: on
+):
+    """
+    Estimates, per dataset of the spancat corpus, how many gold spans
+    the spacy.ngram_suggester.v1 in configs/spancat_default.cfg can
+    propose with the sizes 1..n, and how many candidates that costs
+    per doc and per batch, to choose the sizes. Everything is computed
+    from the SpanIndex sidecars of the corpora without loading Docs.
+    """
+    if split not in SPLITS:
+        msg.fail(f"--split has to be one of {SPLITS}, but found {split}", exits=1)
+    datasets = info("spancat", home=str(data_dir))
+    if sources:
+        datasets = {source: datasets[source] for source in sources}
+    max_sizes = list(range(1, max_size + 1))
+    label_tables = []
+    size_tables = []
+    for source, dataset in sorted(datasets.items()):
+        index = load_span_index(dataset[split].path, spans_key)
+        if len(index) == 0:
+            msg.warn(f"No spans in Doc.spans['{spans_key}'] of {dataset[split].path}")
+            continue
+        label_rows, size_rows = analyze_suggester_split(index, max_sizes, batch_words)
+        label_df = pd.DataFrame(label_rows)
+        size_df = pd.DataFrame(size_rows)
+        msg.divider(f"{source}-{split}: {len(index)} spans in {index.n_docs} docs")
+        label_columns = ["label", "spans", "mean_length", "max_length"]
+        label_columns += [f"recall@{size}" for size in max_sizes]
+        msg.table(
+            label_df[label_columns].round(3).astype(object).values.tolist(),
+            header=label_columns,
+            divider=True
+        )
+        msg.table(
+            size_df.round(3).astype(object).values.tolist(),
+            header=list(size_df.columns),
+            divider=True
+        )
+        label_df.insert(0, "source", source)
+        size_df.insert(0, "source", source)
+        label_tables.append(label_df)
+        size_tables.append(size_df)
+    if output_dir is not None and label_tables:
+        os.makedirs(output_dir, exist_ok=True)
+        labels_path = output_dir / f"suggester-{split}-labels.csv"
+        sizes_path = output_dir / f"suggester-{split}-sizes.csv"
+        pd.concat(label_tables, ignore_index=True).to_csv(labels_path, index=False)
+        pd.concat(size_tables, ignore_index=True).to_csv(sizes_path, index=False)
+        msg.good(f"Saved the tables to {labels_path} and {sizes_path}")
+
+
+if __name__ == "__main__":
+    typer.run(analyze_suggester)
@@ -0,0 +1,118 @@
+"""Benchmark the direct 'ner'/'iob' converters against spaCy's converters"""
+
+import time
+from pathlib import Path
+from typing import Callable, List, Optional
+
+import typer
+from spacy.attrs import ENT_IOB, ENT_TYPE, ORTH, SENT_START, SPACY, TAG
+from spacy.tokens import Doc
+from wasabi import msg
+
+from .convert_to_spans import DIRECT_CONVERTERS, convert_chunk, get_converter, read_chunks
+
+Arg = typer.Argument
+Opt = typer.Option
+
+# Token attributes compared between the outputs of the converters.
+COMPARED_ATTRS = [ORTH, SPACY, TAG, SENT_START, ENT_IOB, ENT_TYPE]
+
+
+def _signature(doc: Doc):
+    return (
+        doc.to_array(COMPARED_ATTRS).tobytes(),
+        [(ent.start, ent.end, ent.label_) for ent in doc.ents],
+        {
+            key: [(span.start, span.end, span.label_) for span in group]
+            for key, group in doc.spans.items()
+        },
+    )
+
+
+def _time(convert: Callable[[int, str], List[Doc]], chunks: List[str], repeat: int):
+    """
+    The best time of 'repeat' runs over all chunks
+    and the docs of the last run.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        docs = [doc for i, chunk in enumerate(chunks) for doc in convert(i, chunk)]
+        best = min(best, time.perf_counter() - start)
+    return best, docs
+
+
+def benchmark_convert(
+    # fmt: off
+    input_path: Path = Arg(..., help="Input file in the 'ner' or 'iob' format", exists=True, dir_okay=False),
+    converter: str = Opt("auto", "--converter", "-c", help="Converter: 'ner', 'iob' or 'auto' to detect it"),
+    n_sents: int = Opt(1, "--n-sents", "-n", help="Number of sentences per doc (0 to disable)"),
+    spans_key: Optional[str] = Opt("sc", "--spans-key", "-sc", help="Spans key to store the entities under, '' for Doc.ents"),
+    preprocess: bool = Opt(False, "--preprocess", "-pp", help="Canonicalize the input lines like scripts.preprocess while reading them"),
+    strip_digits: bool = Opt(False, "--strip-digits", help="Strip the token index at the start of each line (implies --preprocess)"),
+    repeat: int = Opt(3, "--repeat", "-r", help="Report the best time of this many runs"),
+    # fmt: on
+) -> None:
+    """
+    Converts the input with spaCy's converter followed by the transfer
+    of the entities to Doc.spans, as convert_to_spans used to, and with
+    the direct converter, and reports the time of both. The input is read
+    into memory first, so only the conversion itself is timed. Exits with
+    an error if the docs of the two converters differ.
+    """
+    preprocess = preprocess or strip_digits
+    if converter == "auto":
+        converter = get_converter(
+            msg, input_path.suffix[1:], input_path, preprocess=preprocess, strip_digits=strip_digits
+        )
+    if converter not in DIRECT_CONVERTERS:
+        msg.fail(f"No direct converter for '{converter}'", exits=1)
+    chunks = list(read_chunks(
+        input_path,
+        converter,
+        n_sents=n_sents,
+        preprocess=preprocess,
+        strip_digits=strip_digits,
+    ))
+    kwargs = dict(
+        n_sents=n_sents,
+        seg_sents=False,
+        append_morphology=False,
+        merge_subtokens=False,
+        lang=None,
+        model=None,
+        ner_map=None,
+    )
+    spans_keys = [spans_key] if spans_key else None
+    results = {}
+    for name, direct in (("spaCy", False), ("direct", True)):
+        def convert(i: int, chunk: str) -> List[Doc]:
+            return list(convert_chunk(
+                (i, chunk),
+                converter=converter,
+                silent=True,
+                serialize=False,
+                direct=direct,
+                spans_keys=spans_keys,
+                **kwargs,
+            ))
+        results[name] = _time(convert, chunks, repeat)
+    (base_time, base_docs), (direct_time, direct_docs) = results.values()
+    if list(map(_signature, base_docs)) != list(map(_signature, direct_docs)):
+        msg.fail("The direct converter's docs differ from spaCy's", exits=1)
+    n_docs = len(base_docs)
+    n_tokens = sum(len(doc) for doc in base_docs)
+    msg.info(f"Converted {n_docs} docs with {n_tokens} tokens from {input_path}")
+    msg.table(
+        [
+            (name, f"{seconds:.2f}", f"{n_tokens / seconds:,.0f}")
+            for name, (seconds, _) in results.items()
+        ],
+        header=("Converter", "Seconds", "Tokens/s"),
+        divider=True,
+    )
+    msg.good(f"The direct converter is {base_time / direct_time:.1f}x faster")
+
+
+if __name__ == "__main__":
+    typer.run(benchmark_convert)
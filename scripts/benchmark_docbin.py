@@ -0,0 +1,81 @@
+"""Report the size and load time of a corpus in each DocBin format"""
+
+import time
+from pathlib import Path
+from typing import List
+
+import typer
+from spacy.tokens import DocBin
+from spacy.vocab import Vocab
+from wasabi import msg
+
+from ._util import DOCBIN_PROFILES, DocBinFormat, docbin_from_bytes, load_docbin, shard_paths
+
+Arg = typer.Argument
+Opt = typer.Option
+
+
+def _merge(docbins: List[DocBin]) -> DocBin:
+    docbin, *others = docbins
+    for other in others:
+        docbin.merge(other)
+    return docbin
+
+
+def benchmark_docbin(
+    # fmt: off
+    input_path: Path = Arg(..., help="Input .spacy file or directory of shards", exists=True),
+    profiles: List[str] = Opt(list(DOCBIN_PROFILES), "--profile", "-ap", help="Attribute profiles to compare"),
+    compressions: List[str] = Opt(["zlib", "zstd"], "--compression", "-cz", help="Compressions to compare, optionally with a level like 'zstd:19'"),
+    repeat: int = Opt(3, "--repeat", "-r", help="Report the best time of this many runs"),
+    # fmt: on
+) -> None:
+    """
+    Serializes the corpus at 'input_path' in memory with each
+    combination of --profile and --compression and reports the
+    size, the time to write it and the time to load it and decode
+    all Docs with get_docs, like a training run does. The ratio
+    is to the size of the 'full' profile with zlib, which is how
+    the corpora used to be written. Formats whose compression
+    isn't available are skipped.
+    """
+    docbin = _merge([load_docbin(shard) for shard in shard_paths(input_path)])
+    n_tokens = sum(len(tokens) for tokens in docbin.tokens)
+    msg.info(f"Loaded {len(docbin)} docs with {n_tokens} tokens from {input_path}")
+    base_size = len(DocBinFormat().to_bytes(docbin))
+    vocab = Vocab()
+    rows = []
+    for profile in profiles:
+        for compression in compressions:
+            try:
+                docbin_format = DocBinFormat.from_options(profile, compression)
+                write_time = float("inf")
+                load_time = float("inf")
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    data = docbin_format.to_bytes(docbin)
+                    write_time = min(write_time, time.perf_counter() - start)
+                    start = time.perf_counter()
+                    for _ in docbin_from_bytes(data).get_docs(vocab):
+                        pass
+                    load_time = min(load_time, time.perf_counter() - start)
+            except (ValueError, ImportError) as e:
+                msg.warn(f"Skipping {profile}/{compression}: {e}")
+                continue
+            rows.append((
+                profile,
+                compression,
+                f"{len(data):,}",
+                f"{len(data) / base_size:.2f}",
+                f"{write_time:.2f}",
+                f"{load_time:.2f}",
+            ))
+    msg.table(
+        rows,
+        header=("Profile", "Compression", "Bytes", "Ratio", "Write (s)", "Load (s)"),
+        divider=True,
+    )
+
+
+if __name__ == "__main__":
+    typer.run(benchmark_docbin)
@@ -1,17 +1,42 @@
 """Monkey-patched version of the convert command that transfers entities to Doc.spans"""
 
+import re
 import random
+from contextlib import closing
+from functools import partial
+from itertools import islice
+from multiprocessing import Pool
 from pathlib import Path
-from typing import Iterable, Optional, Union
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
 
+import numpy
 import srsly
 import typer
-from spacy.cli.convert import CONVERTERS, _get_converter, _write_docs_to_file
+from spacy.attrs import ENT_IOB, ENT_TYPE, SENT_START, TAG
+from spacy.cli.convert import CONVERTERS, autodetect_ner_format
 from spacy.cli.convert import verify_cli_args, walk_directory
-from spacy.tokens import Doc, DocBin, SpanGroup
+from spacy.tokens import Doc, DocBin, Span, SpanGroup
+from spacy.util import minibatch
+from spacy.vocab import Vocab
 from wasabi import Printer
 
+from ._util import CACHE_SIZE, CorpusWriter, DocBinFormat, OutputCache, SpanIndex
+from ._util import corpus_output_path, sidecar_paths, transfer_ents_to_spans
+from ._split import stratified_split
+from .preprocess import canonicalize
+
 FILE_TYPE = "spacy"
+# Converters for sentence-per-line or blank-line separated formats. Their
+# input can be read and converted a chunk of sentences at a time.
+CHUNKED_CONVERTERS = ("conll", "ner", "iob")
+CHUNK_SIZE = 5000
+DOC_DELIMITER = "-DOCSTART-"
+# The doc delimiter line of the 'ner' format as spaCy's converter splits on it.
+NER_DOC_DELIMITER = "-DOCSTART- -X- O O"
+# Tags the direct converters decode, anything else goes to spaCy's converters.
+_IOB_TAG = re.compile(r"[BILU]-.+", re.DOTALL)
+# Token attributes the direct converters set, in the order of their array.
+DIRECT_ATTRS = [TAG, SENT_START, ENT_IOB, ENT_TYPE]
 Arg = typer.Argument
 Opt = typer.Option
 
@@ -32,7 +57,20 @@ def convert_cli(
     use_ents: bool = Opt(False, "--use-ents", "-e", help="Use Doc.ents, don't transfer to Doc.spans"),
     train_size: Optional[float] = Opt(None, "--train-size", "-sz", help="Size of the training dataset for splitting"),
     shuffle: bool = Opt(False, "--shuffle", "-sf", help="Shuffle the dataset before splitting"),
-    seed: Optional[int] = Opt(None, "--seed", "-sd", help="Random seed for shuffling the data")
+    seed: Optional[int] = Opt(None, "--seed", "-sd", help="Random seed for shuffling the data"),
+    stratify: bool = Opt(False, "--stratify", "-st", help="Balance the entity labels over the train and dev split (needs all docs in memory)"),
+    shard_size: int = Opt(0, "--shard-size", "-ss", help="Stream the docs to shards of this many docs (0 to disable)"),
+    n_process: int = Opt(1, "--n-process", "-np", help="Number of processes to convert files or chunks of a file with"),
+    ents_output_dir: Optional[Path] = Opt(None, "--ents-output-dir", "-eo", help="Also write the docs with Doc.ents to this directory", exists=True),
+    extra_spans_keys: List[str] = Opt([], "--extra-spans-key", "-esc", help="Also store the entities under this spans key (can be repeated)"),
+    preprocess: bool = Opt(False, "--preprocess", "-pp", help="Canonicalize the input lines like scripts.preprocess while reading them"),
+    strip_digits: bool = Opt(False, "--strip-digits", help="Strip the token index at the start of each line (implies --preprocess)"),
+    remove_prefix: str = Opt("", "--remove-prefix", "-rp", help="Remove this prefix from the names of the output files"),
+    spacy_converter: bool = Opt(False, "--spacy-converter", help="Always use spaCy's converters, also for the 'ner' and 'iob' formats"),
+    attrs_profile: str = Opt("auto", "--attrs-profile", "-ap", help="Token attributes to store: 'minimal' (tokens and sentence starts), 'ner' (also the entities), 'full' (also tags, lemmas etc. and Doc.user_data) or 'auto' (minimal for Doc.spans, ner for Doc.ents)"),
+    compression: str = Opt("zlib", "--compression", "-cz", help="Compression of the .spacy files: 'zlib' or 'zstd', optionally with a level like 'zstd:19'"),
+    cache_dir: Optional[Path] = Opt(None, "--cache-dir", "-cd", help="Cache the output per input file contents and options in this directory"),
+    cache_size: float = Opt(CACHE_SIZE, "--cache-size", help="Maximum size of the cache in GB")
     # fmt: on
 ):
     """
@@ -48,6 +86,45 @@ def convert_cli(
     Here, we added an additional step that transfers the entitites into
     the Doc.spans attribute for Span Categorization.
 
+    With --shard-size the input is streamed: docs are converted a chunk
+    of sentences at a time and written to a directory of DocBin shards
+    named like the output file, which spaCy's corpus reader accepts in
+    place of a single .spacy file. Memory use then doesn't depend on the
+    size of the input.
+
+    With --n-process the files in the input directory, or the chunks of
+    a single input file, are converted by a pool of processes. The output
+    is the same as with a single process.
+
+    With --ents-output-dir each input is parsed once and written both as
+    a Doc.ents corpus to that directory and as a Doc.spans corpus to
+    output_dir, with the same train/dev split.
+
+    With --stratify the --train-size split balances the entity labels
+    over train and dev, so rare labels aren't left out of the dev set.
+
+    With --preprocess the input lines go through the same canonicalization
+    as scripts.preprocess while they're read, so raw assets are converted
+    in one pass without writing a cleaned copy first. --remove-prefix drops
+    a prefix like 'raw-' from the output file names.
+
+    The 'ner' and 'iob' formats are converted by a direct converter that
+    builds the Docs from the tokens and tags and sets Doc.spans without
+    going through Doc.ents, with the same output as spaCy's converters.
+    Chunks it can't read and options like --seg-sents fall back to
+    spaCy's converter, --spacy-converter always uses it.
+
+    The .spacy files only store the token attributes of --attrs-profile.
+    By default that's the tokens, sentence starts and Doc.spans for span
+    corpora and also the entity annotation for Doc.ents corpora. POS tags,
+    lemmas, morphology, dependencies and Doc.user_data are dropped, 'full'
+    stores spaCy's default attributes and Doc.user_data. zstd
+    corpora need _util.load_docbin and the readers in _util to be read.
+
+    With --cache-dir the output for each input file is cached under a
+    hash of the file's contents and the conversion options, and restored
+    from there when the same input is converted again.
+
     DOCS: https://spacy.io/api/cli#convert
     """
     input_path = Path(input_path)
@@ -55,7 +132,10 @@ def convert_cli(
     silent = output_dir == "-"
     msg = Printer(no_print=silent)
     verify_cli_args(msg, input_path, output_dir, FILE_TYPE, converter, ner_map)
-    converter = _get_converter(msg, converter, input_path)
+    preprocess = preprocess or strip_digits
+    converter = get_converter(
+        msg, converter, input_path, preprocess=preprocess, strip_digits=strip_digits
+    )
     convert(
         input_path,
         output_dir,
@@ -74,40 +154,510 @@ def convert_cli(
         train_size=train_size,
         shuffle=shuffle,
         seed=seed,
+        stratify=stratify,
+        shard_size=shard_size,
+        n_process=n_process,
+        ents_output_dir=ents_output_dir,
+        extra_spans_keys=extra_spans_keys,
+        preprocess=preprocess,
+        strip_digits=strip_digits,
+        remove_prefix=remove_prefix,
+        direct=not spacy_converter,
+        attrs_profile=attrs_profile,
+        compression=compression,
+        cache_dir=cache_dir,
+        cache_size=cache_size,
+    )
+
+
+def get_converter(
+    msg: Printer,
+    converter: str,
+    input_path: Path,
+    *,
+    preprocess: bool = False,
+    strip_digits: bool = False,
+) -> str:
+    """
+    Same as spaCy's _get_converter, but only reads the lines of the
+    input that are used to autodetect the NER format, not the whole file.
+    """
+    if input_path.is_dir():
+        if converter == "auto":
+            input_locs = walk_directory(input_path, suffix=None)
+            file_types = list(set([loc.suffix[1:] for loc in input_locs]))
+            if len(file_types) >= 2:
+                file_types_str = ",".join(file_types)
+                msg.fail("All input files must be same type", file_types_str, exits=1)
+            input_path = input_locs[0]
+        else:
+            input_path = walk_directory(input_path, suffix=converter)[0]
+    if converter == "auto":
+        converter = input_path.suffix[1:]
+    if converter == "ner" or converter == "iob":
+        lines = _read_lines(input_path, preprocess=preprocess, strip_digits=strip_digits)
+        head = "".join(islice(lines, 20))
+        lines.close()
+        converter_autodetect = autodetect_ner_format(head)
+        if converter_autodetect == "ner":
+            msg.info("Auto-detected token-per-line NER format")
+            converter = converter_autodetect
+        elif converter_autodetect == "iob":
+            msg.info("Auto-detected sentence-per-line NER format")
+            converter = converter_autodetect
+        else:
+            msg.warn(
+                "Can't automatically detect NER format. "
+                "Conversion may not succeed. "
+                "See https://spacy.io/api/cli#convert"
+            )
+    return converter
+
+
+def _read_lines(
+    input_loc: Path, *, preprocess: bool = False, strip_digits: bool = False
+) -> Iterator[str]:
+    """
+    Reads the lines of the input file, canonicalized like
+    scripts.preprocess does if 'preprocess' is set.
+    """
+    with input_loc.open("r", encoding="utf-8") as infile:
+        if preprocess:
+            yield from canonicalize(infile, strip_digits=strip_digits)
+        else:
+            yield from infile
+
+
+def read_chunks(
+    input_loc: Path,
+    converter: str,
+    *,
+    n_sents: int,
+    chunk_size: int = CHUNK_SIZE,
+    preprocess: bool = False,
+    strip_digits: bool = False,
+) -> Iterator[str]:
+    """
+    Reads the input file in chunks of about 'chunk_size' sentences.
+    Chunks are only cut at sentence boundaries after a multiple of
+    'n_sents' sentences, or right before a document delimiter if the
+    file has them, so the converter builds the same docs as it would
+    from the whole file. Formats that aren't sentence based are read
+    in one go. With 'preprocess' the lines are canonicalized on the
+    way in, so the chunks are the same as for a preprocessed file.
+    """
+    infile = _read_lines(input_loc, preprocess=preprocess, strip_digits=strip_digits)
+    with closing(infile):
+        if converter not in CHUNKED_CONVERTERS:
+            yield "".join(infile)
+            return
+        if n_sents > 1:
+            chunk_size = max(n_sents, chunk_size - chunk_size % n_sents)
+        # iob has one sentence per line, the others separate them by blank lines.
+        line_per_sent = converter == "iob"
+        has_docs = None
+        lines: List[str] = []
+        n_seen = 0
+        for line in infile:
+            is_blank = not line.strip()
+            if has_docs is None and not is_blank:
+                has_docs = line.startswith(DOC_DELIMITER)
+            if line_per_sent:
+                is_boundary = True
+            elif has_docs:
+                is_boundary = line.startswith(DOC_DELIMITER)
+            else:
+                is_boundary = not is_blank and bool(lines) and not lines[-1].strip()
+            if n_seen >= chunk_size and is_boundary:
+                yield _join_chunk(lines, line_per_sent)
+                lines = []
+                n_seen = 0
+            if line_per_sent or (is_blank and lines and lines[-1].strip()):
+                n_seen += 1
+            lines.append(line)
+        if lines:
+            yield _join_chunk(lines, line_per_sent)
+
+
+def _join_chunk(lines: List[str], line_per_sent: bool) -> str:
+    chunk = "".join(lines)
+    # A trailing newline would turn into an empty sentence for 'iob'.
+    if line_per_sent and chunk.endswith("\n"):
+        chunk = chunk[:-1]
+    return chunk
+
+
+def _iter_docs(
+    input_loc: Path,
+    converter: str,
+    *,
+    n_sents: int,
+    silent: bool,
+    pool: Optional[Pool] = None,
+    n_process: int = 1,
+    preprocess: bool = False,
+    strip_digits: bool = False,
+    **kwargs,
+) -> Iterator[Doc]:
+    """
+    Converts the input file chunk by chunk. The converter
+    warnings are only printed for the first chunk.
+    If a 'pool' of 'n_process' processes is given, the chunks
+    are converted by it and the docs are yielded in input order.
+    """
+    chunks = enumerate(read_chunks(
+        input_loc,
+        converter,
+        n_sents=n_sents,
+        preprocess=preprocess,
+        strip_digits=strip_digits,
+    ))
+    convert = partial(
+        convert_chunk, converter=converter, n_sents=n_sents, silent=silent, **kwargs
+    )
+    if pool is None:
+        for i, chunk in chunks:
+            yield from convert((i, chunk), serialize=False)
+        return
+    # Hand out a few chunks per process at a time, so the input
+    # isn't read faster than the docs are written.
+    for batch in minibatch(chunks, size=n_process * 2):
+        for data in pool.imap(convert, batch):
+            yield from DocBin().from_bytes(data).get_docs(Vocab())
+
+
+def convert_chunk(
+    indexed_chunk: Tuple[int, str],
+    *,
+    converter: str,
+    silent: bool,
+    serialize: bool = True,
+    direct: bool = True,
+    spans_keys: Optional[Sequence[str]] = None,
+    **kwargs,
+) -> Union[bytes, Iterable[Doc]]:
+    """
+    Converts a chunk with the direct converter for the format if there
+    is one and the options allow it, or with spaCy's converter. With
+    'spans_keys' the entities are stored in Doc.spans instead of Doc.ents.
+    """
+    i, chunk = indexed_chunk
+    docs = None
+    if direct and converter in DIRECT_CONVERTERS and not (kwargs["seg_sents"] or kwargs["model"]):
+        docs = DIRECT_CONVERTERS[converter](chunk, n_sents=kwargs["n_sents"], spans_keys=spans_keys)
+    if docs is None:
+        docs = CONVERTERS[converter](chunk, no_print=silent or i > 0, **kwargs)
+        if spans_keys:
+            docs = transfer_ents_to_spans(docs, spans_keys)
+    if not serialize:
+        return docs
+    # Docs are sent back to the main process as a DocBin, it's much
+    # cheaper to pickle than the docs and their vocab.
+    return DocBin(docs=docs, store_user_data=True).to_bytes()
+
+
+def decode_iob(
+    tags: Sequence[str], starts: numpy.ndarray
+) -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray, List[str]]:
+    """
+    Decodes the IOB (or BILUO) tags of a sequence of tokens into
+    entities in one vectorized pass, reading them like spaCy's
+    iob_to_biluo: every tag but O starts an entity, unless it's an
+    I- or L- tag of the same label as the tag before it. Entities
+    never continue into a token marked in 'starts', like the first
+    token of a sentence. Returns the start and end offset and the
+    label id of each entity and the labels. Raises a ValueError for
+    tags that aren't O or [BILU]-label.
+    """
+    tag_ids: Dict[str, int] = {}
+    ids = numpy.fromiter(
+        (tag_ids.setdefault(tag, len(tag_ids)) for tag in tags),
+        dtype="int64",
+        count=len(tags),
     )
+    label_ids: Dict[str, int] = {}
+    tag_label = numpy.full(len(tag_ids), -1, dtype="int64")
+    tag_continues = numpy.zeros(len(tag_ids), dtype="bool")
+    for tag, tag_id in tag_ids.items():
+        if tag == "O":
+            continue
+        if not _IOB_TAG.fullmatch(tag):
+            raise ValueError(f"Can't decode the IOB tag {tag!r}")
+        tag_label[tag_id] = label_ids.setdefault(tag[2:], len(label_ids))
+        tag_continues[tag_id] = tag[0] in "IL"
+    label = tag_label[ids]
+    inside = label >= 0
+    continues = inside & tag_continues[ids] & ~numpy.asarray(starts, dtype="bool")
+    continues[1:] &= label[1:] == label[:-1]
+    continues[:1] = False
+    begins = numpy.flatnonzero(inside & ~continues)
+    # An entity ends before the first token that doesn't continue it.
+    ends = numpy.flatnonzero(inside & ~numpy.append(continues[1:], False)) + 1
+    return begins, ends, label[begins], list(label_ids)
+
+
+def _parse_conll_ner(text: str, n_sents: int) -> Optional[List[List[List[List[str]]]]]:
+    """
+    Splits a chunk of the 'ner' format into docs of sentences of the
+    columns of each token, grouped like spaCy's conll_ner_to_docs does.
+    Returns None if the chunk needs spaCy's converter.
+    """
+    if NER_DOC_DELIMITER in text:
+        doc_texts = text.strip().split(NER_DOC_DELIMITER)
+    elif "\n\n" in text and n_sents:
+        sents = text.split("\n\n")
+        doc_texts = ["\n\n".join(sents[i:i + n_sents]) for i in range(0, len(sents), n_sents)]
+    elif "\n\n" in text or n_sents:
+        doc_texts = [text]
+    else:
+        # Without sentence or doc boundaries spaCy segments the sentences.
+        return None
+    docs = []
+    for doc_text in doc_texts:
+        sents = []
+        for sent_text in doc_text.strip().split("\n\n"):
+            rows = [line.split() for line in sent_text.split("\n") if line.strip()]
+            if not rows:
+                continue
+            n_cols = min(len(row) for row in rows)
+            if n_cols < 2:
+                return None
+            sents.append([
+                [row[0], row[1] if n_cols > 2 else "-", row[n_cols - 1]]
+                for row in rows
+            ])
+        if sents:
+            docs.append(sents)
+    return docs
 
 
-def transfer_ents_to_spans(docs: Iterable[Doc], spans_key: str) -> Iterable[Doc]:
-    _docs = []
+def _parse_iob(text: str, n_sents: int) -> Optional[List[List[List[List[str]]]]]:
+    """
+    Splits a chunk of the 'iob' format into docs of the sentences
+    of 'n_sents' lines like spaCy's iob_to_docs does. Returns None
+    if the chunk needs spaCy's converter.
+    """
+    if n_sents < 1:
+        return None
+    lines = text.split("\n")
+    docs = []
+    for i in range(0, len(lines), n_sents):
+        doc = []
+        for line in lines[i:i + n_sents]:
+            if not line.strip():
+                continue
+            tokens = [token.split("|") for token in line.split()]
+            n_cols = len(tokens[0])
+            if n_cols not in (2, 3) or any(len(token) != n_cols for token in tokens):
+                return None
+            doc.append([
+                [token[0], token[1] if n_cols == 3 else "-", token[-1]]
+                for token in tokens
+            ])
+        docs.append(doc)
+    return docs
+
+
+def _docs_from_rows(
+    docs: List[List[List[List[str]]]],
+    *,
+    ents_across_sents: bool = False,
+    spans_keys: Optional[Sequence[str]] = None,
+) -> List[Doc]:
+    """
+    Builds the Docs from the word, tag and IOB columns of the tokens
+    in each sentence of each doc. The entities of the whole chunk are
+    decoded at once and the token attributes are set from one array,
+    with the entities as Doc.ents, or directly as Doc.spans under
+    'spans_keys'.
+    """
+    vocab = Vocab()
+    rows = [row for doc in docs for sent in doc for row in sent]
+    sent_start = numpy.full(len(rows), -1, dtype="int64")
+    starts = numpy.zeros(len(rows), dtype="bool")
+    doc_starts = []
+    i = 0
     for doc in docs:
-        spans = [ent for ent in doc.ents]
-        group = SpanGroup(doc, name=spans_key, spans=spans)
-        doc.spans[spans_key] = group
-        doc.set_ents([])
-        _docs.append(doc)
-    return _docs
+        doc_starts.append(i)
+        for sent in doc:
+            sent_start[i] = 1
+            starts[i] = not ents_across_sents or i == doc_starts[-1]
+            i += len(sent)
+    doc_starts.append(i)
+    begins, ends, label_ids, labels = decode_iob([row[2] for row in rows], starts)
+    tags = [row[1] for row in rows]
+    tag_hashes = {tag: vocab.strings.add(tag) for tag in set(tags)}
+    label_hashes = numpy.asarray([vocab.strings.add(label) for label in labels], dtype="uint64")
+    array = numpy.zeros((len(rows), len(DIRECT_ATTRS)), dtype="uint64")
+    array[:, 0] = numpy.fromiter((tag_hashes[tag] for tag in tags), dtype="uint64", count=len(tags))
+    array[:, 1] = sent_start.astype("uint64")
+    array[:, 2] = 2
+    if not spans_keys:
+        # Tokens inside an entity are I, its first token is B.
+        inside = numpy.zeros(len(rows) + 1, dtype="int64")
+        numpy.add.at(inside, begins, 1)
+        numpy.add.at(inside, ends, -1)
+        inside = numpy.cumsum(inside[:-1]) > 0
+        array[inside, 2] = 1
+        array[begins, 2] = 3
+        ent_of_token = numpy.searchsorted(begins, numpy.flatnonzero(inside), side="right") - 1
+        array[inside, 3] = label_hashes[label_ids[ent_of_token]]
+    doc_ents = numpy.searchsorted(begins, doc_starts)
+    output = []
+    for doc_id in range(len(docs)):
+        start, end = doc_starts[doc_id], doc_starts[doc_id + 1]
+        doc = Doc(vocab, words=[row[0] for row in rows[start:end]])
+        doc.from_array(DIRECT_ATTRS, array[start:end])
+        if spans_keys:
+            ent_slice = slice(doc_ents[doc_id], doc_ents[doc_id + 1])
+            spans = [
+                Span(doc, ent_start, ent_end, labels[label_id])
+                for ent_start, ent_end, label_id in zip(
+                    (begins[ent_slice] - start).tolist(),
+                    (ends[ent_slice] - start).tolist(),
+                    label_ids[ent_slice].tolist(),
+                )
+            ]
+            for key in spans_keys:
+                doc.spans[key] = SpanGroup(doc, name=key, spans=spans)
+        output.append(doc)
+    return output
+
+
+def conll_ner_to_docs(
+    text: str, *, n_sents: int = 1, spans_keys: Optional[Sequence[str]] = None
+) -> Optional[List[Doc]]:
+    """
+    Direct converter for the 'ner' format, with the same output as
+    spaCy's conll_ner_to_docs without the BILUO tags and Span objects
+    in between. Returns None if the chunk needs spaCy's converter.
+    """
+    docs = _parse_conll_ner(text, n_sents)
+    if docs is None:
+        return None
+    try:
+        return _docs_from_rows(docs, spans_keys=spans_keys)
+    except ValueError:
+        return None
+
+
+def iob_to_docs(
+    text: str, *, n_sents: int = 1, spans_keys: Optional[Sequence[str]] = None
+) -> Optional[List[Doc]]:
+    """
+    Direct converter for the 'iob' format, with the same output
+    as spaCy's iob_to_docs. Returns None if the chunk needs spaCy's
+    converter.
+    """
+    docs = _parse_iob(text, n_sents)
+    if docs is None:
+        return None
+    try:
+        # spaCy decodes the tags of a doc across its sentences.
+        return _docs_from_rows(docs, ents_across_sents=True, spans_keys=spans_keys)
+    except ValueError:
+        return None
+
+
+DIRECT_CONVERTERS = {"ner": conll_ner_to_docs, "iob": iob_to_docs}
 
 
 def _save_docs_to_disk(
     docs: Iterable[Doc],
-    output_dir: Union[str, Path],
     input_loc: Path,
     is_dev: bool,
     msg: Printer,
+    **writer_kwargs,
+):
+    writer = CorpusWriter(input_loc, is_dev, msg=msg, **writer_kwargs)
+    for doc in docs:
+        writer.add(doc)
+    writer.close()
+
+
+def _split_docs_to_disk(
+    docs: Iterable[Doc],
+    input_loc: Path,
+    *,
+    train_size: Optional[float],
+    shuffle: bool,
+    seed: Optional[int],
+    stratify: bool = False,
+    msg: Printer,
+    **writer_kwargs,
 ):
-    db = DocBin(docs=docs, store_user_data=True)
-    len_docs = len(db)
-    data = db.to_bytes()  # type: ignore[assignment]
+    docs = list(docs)
+    if train_size and stratify:
+        msg.info(f"Splitting files with train_size {train_size}, stratified by entity label")
+        # The entities are in Doc.spans already if they weren't transferred.
+        transferred = writer_kwargs.get("transfer", True)
+        index = SpanIndex.from_docs(docs, None if transferred else writer_kwargs["spans_keys"][0])
+        splits = stratified_split(
+            len(docs), index.doc_id, index.label, [train_size, 1 - train_size], seed=seed
+        )
+        train_docs = [doc for doc, split in zip(docs, splits) if split == 0]
+        dev_docs = [doc for doc, split in zip(docs, splits) if split == 1]
+        msg.text(
+            f"Dataset has been split with train size={len(train_docs)} "
+            f"and dev size={len(dev_docs)}"
+        )
+        _save_docs_to_disk(train_docs, input_loc, is_dev=False, msg=msg, **writer_kwargs)
+        _save_docs_to_disk(dev_docs, input_loc, is_dev=True, msg=msg, **writer_kwargs)
+    elif train_size:
+        msg.info(f"Splitting files with train_size {train_size}")
+        if shuffle:
+            if seed:
+                msg.info(f"Using random seed {seed}")
+                random.seed(seed)
+            msg.info("Shuffling the documents before splitting")
+            random.shuffle(docs)
+        num_training = int(train_size * len(docs))
+        train_docs = docs[:num_training]
+        dev_docs = docs[num_training:]
+        msg.text(
+            f"Dataset has been split with train size={len(train_docs)} "
+            f"and dev size={len(dev_docs)}"
+        )
 
-    if is_dev:
-        filename = input_loc.stem + "-dev" + input_loc.suffix
+        _save_docs_to_disk(train_docs, input_loc, is_dev=False, msg=msg, **writer_kwargs)
+        _save_docs_to_disk(dev_docs, input_loc, is_dev=True, msg=msg, **writer_kwargs)
     else:
-        filename = input_loc.parts[-1]
+        _save_docs_to_disk(docs, input_loc, is_dev=False, msg=msg, **writer_kwargs)
+
 
-    output_file = Path(output_dir) / filename
-    output_file = output_file.with_suffix(f".{FILE_TYPE}")
-    _write_docs_to_file(data, output_file, FILE_TYPE)
-    msg.good(f"Generated output file ({len_docs} documents): {output_file}")
+def _stream_docs_to_disk(
+    docs: Iterable[Doc],
+    input_loc: Path,
+    *,
+    train_size: Optional[float],
+    seed: Optional[int],
+    msg: Printer,
+    **writer_kwargs,
+):
+    """
+    Writes the docs to shards as they come in. Without knowing the
+    number of docs up front the train/dev split can't cut the corpus
+    at a position, so each doc is assigned to train with probability
+    'train_size' instead.
+    """
+    if not train_size:
+        _save_docs_to_disk(docs, input_loc, False, msg, **writer_kwargs)
+        return
+    msg.info(f"Splitting files with train_size {train_size}, assigning docs at random")
+    if seed:
+        msg.info(f"Using random seed {seed}")
+    rng = random.Random(seed)
+    train_writer = CorpusWriter(input_loc, False, msg=msg, **writer_kwargs)
+    dev_writer = CorpusWriter(input_loc, True, msg=msg, **writer_kwargs)
+    for doc in docs:
+        writer = train_writer if rng.random() < train_size else dev_writer
+        writer.add(doc)
+    msg.text(
+        f"Dataset has been split with train size={train_writer.n_docs} "
+        f"and dev size={dev_writer.n_docs}"
+    )
+    train_writer.close()
+    dev_writer.close()
 
 
 def convert(
@@ -129,53 +679,196 @@ def convert(
     train_size: Optional[float] = None,
     shuffle: bool = True,
     seed: Optional[int] = None,
+    stratify: bool = False,
+    shard_size: int = 0,
+    n_process: int = 1,
+    ents_output_dir: Optional[Union[str, Path]] = None,
+    extra_spans_keys: Sequence[str] = (),
+    preprocess: bool = False,
+    strip_digits: bool = False,
+    remove_prefix: str = "",
+    direct: bool = True,
+    attrs_profile: str = "auto",
+    compression: str = "zlib",
+    cache_dir: Optional[Union[str, Path]] = None,
+    cache_size: float = CACHE_SIZE,
 ) -> None:
     input_path = Path(input_path)
     if not msg:
         msg = Printer(no_print=silent)
+    if use_ents and ents_output_dir is not None:
+        msg.fail("Can't use --ents-output-dir together with --use-ents", exits=1)
+    try:
+        DocBinFormat.from_options(attrs_profile, compression)
+    except ValueError as e:
+        msg.fail(str(e), exits=1)
     ner_map = srsly.read_json(ner_map) if ner_map is not None else None
-    for input_loc in walk_directory(input_path, converter):
-        with input_loc.open("r", encoding="utf-8") as infile:
-            input_data = infile.read()
-        # Use converter function to convert data
-        func = CONVERTERS[converter]
-        docs = func(
-            input_data,
-            n_sents=n_sents,
-            seg_sents=seg_sents,
-            append_morphology=morphology,
-            merge_subtokens=merge_subtokens,
-            lang=lang,
-            model=model,
-            no_print=silent,
-            ner_map=ner_map,
+    converter_kwargs = dict(
+        n_sents=n_sents,
+        seg_sents=seg_sents,
+        append_morphology=morphology,
+        merge_subtokens=merge_subtokens,
+        lang=lang,
+        model=model,
+        ner_map=ner_map,
+    )
+    convert_file = partial(
+        _convert_file,
+        output_dir=output_dir,
+        converter=converter,
+        converter_kwargs=converter_kwargs,
+        silent=silent,
+        ents_output_dir=ents_output_dir,
+        spans_keys=[spans_key, *extra_spans_keys],
+        use_ents=use_ents,
+        train_size=train_size,
+        shuffle=shuffle,
+        seed=seed,
+        stratify=stratify,
+        shard_size=shard_size,
+        preprocess=preprocess or strip_digits,
+        strip_digits=strip_digits,
+        remove_prefix=remove_prefix,
+        direct=direct,
+        attrs_profile=attrs_profile,
+        compression=compression,
+        cache=OutputCache(cache_dir, cache_size) if cache_dir is not None else None,
+    )
+    input_locs = walk_directory(input_path, converter)
+    if n_process > 1 and len(input_locs) > 1:
+        # Each file is converted by one process and written to its own
+        # output file(s), so the results don't depend on the scheduling.
+        msg.info(f"Converting {len(input_locs)} files with {n_process} processes")
+        with Pool(min(n_process, len(input_locs))) as pool:
+            for _ in pool.imap(convert_file, input_locs):
+                pass
+    elif n_process > 1 and input_locs:
+        msg.info(f"Converting chunks of {input_locs[0]} with {n_process} processes")
+        with Pool(n_process) as pool:
+            convert_file(input_locs[0], msg=msg, pool=pool, n_process=n_process)
+    else:
+        for input_loc in input_locs:
+            convert_file(input_loc, msg=msg)
+
+
+def _convert_file(
+    input_loc: Path,
+    output_dir: Union[str, Path],
+    *,
+    converter: str,
+    converter_kwargs: Dict[str, Any],
+    silent: bool,
+    ents_output_dir: Optional[Union[str, Path]],
+    spans_keys: Sequence[str],
+    use_ents: bool,
+    train_size: Optional[float],
+    shuffle: bool,
+    seed: Optional[int],
+    stratify: bool,
+    shard_size: int,
+    preprocess: bool = False,
+    strip_digits: bool = False,
+    remove_prefix: str = "",
+    direct: bool = True,
+    attrs_profile: str = "auto",
+    compression: str = "zlib",
+    cache: Optional[OutputCache] = None,
+    msg: Optional[Printer] = None,
+    pool: Optional[Pool] = None,
+    n_process: int = 1,
+) -> None:
+    if not msg:
+        msg = Printer(no_print=silent)
+    ents_dir = output_dir if use_ents else ents_output_dir
+    spans_dir = None if use_ents else output_dir
+    if cache is not None and train_size and seed is None and (shuffle or shard_size):
+        msg.warn("Not caching a random split without --seed")
+        cache = None
+    if cache is not None:
+        output_files = [
+            corpus_output_path(output_dir, input_loc, is_dev, remove_prefix)
+            for is_dev in ([False, True] if train_size else [False])
+            for output_dir in (ents_dir, spans_dir)
+            if output_dir is not None
+        ]
+        output_files += [path for f in output_files for path in sidecar_paths(f)]
+        cache_key = cache.key(
+            [input_loc],
+            # The output layout: which corpora are written and their names.
+            ents_output=ents_dir is not None,
+            spans_output=spans_dir is not None,
+            remove_prefix=remove_prefix,
+            output_names=[path.name for path in output_files],
+            converter=converter,
+            spans_keys=spans_keys,
+            use_ents=use_ents,
+            train_size=train_size,
+            shuffle=shuffle,
+            seed=seed,
+            stratify=stratify,
+            shard_size=shard_size,
+            preprocess=preprocess,
+            strip_digits=strip_digits,
+            attrs_profile=attrs_profile,
+            compression=compression,
+            **converter_kwargs,
         )
-        docs = list(docs)
-        # Monkeypatched version converting docs to spans
-        if not use_ents:
-            msg.info("Transferring entities to doc.spans")
-            docs = transfer_ents_to_spans(docs, spans_key)
-
-        if train_size:
-            msg.info(f"Splitting files with train_size {train_size}")
-            if shuffle:
-                if seed:
-                    msg.info(f"Using random seed {seed}")
-                    random.seed(seed)
-                msg.info("Shuffling the documents before splitting")
-                random.shuffle(docs)
-            num_training = int(train_size * len(docs))
-            train_docs = docs[:num_training]
-            dev_docs = docs[num_training:]
-            msg.text(
-                f"Dataset has been split with train size={len(train_docs)} "
-                f"and dev size={len(dev_docs)}"
-            )
+        if cache.restore(cache_key, output_files):
+            msg.good(f"Restored the output for {input_loc} from the cache")
+            return
+    # Without a Doc.ents corpus the converter can set Doc.spans right away.
+    spans_only = ents_dir is None
+    # Use converter function to convert data
+    docs = _iter_docs(
+        input_loc,
+        converter,
+        silent=silent,
+        pool=pool,
+        n_process=n_process,
+        preprocess=preprocess,
+        strip_digits=strip_digits,
+        direct=direct,
+        spans_keys=spans_keys if spans_only else None,
+        **converter_kwargs,
+    )
+    # Monkeypatched version converting docs to spans
+    if not use_ents:
+        msg.info(f"Transferring entities to doc.spans {spans_keys}")
+        if ents_output_dir is not None:
+            msg.info(f"Also writing entities as doc.ents to {ents_output_dir}")
+    writer_kwargs = dict(
+        ents_dir=ents_dir,
+        spans_dir=spans_dir,
+        spans_keys=spans_keys,
+        shard_size=shard_size,
+        remove_prefix=remove_prefix,
+        transfer=not spans_only,
+        attrs_profile=attrs_profile,
+        compression=compression,
+    )
 
-            _save_docs_to_disk(train_docs, output_dir, input_loc, is_dev=False, msg=msg)
-            _save_docs_to_disk(dev_docs, output_dir, input_loc, is_dev=True, msg=msg)
-        else:
-            _save_docs_to_disk(docs, output_dir, input_loc, is_dev=False, msg=msg)
+    if shard_size and not (train_size and stratify):
+        _stream_docs_to_disk(
+            docs,
+            input_loc,
+            train_size=train_size,
+            seed=seed,
+            msg=msg,
+            **writer_kwargs,
+        )
+    else:
+        _split_docs_to_disk(
+            docs,
+            input_loc,
+            train_size=train_size,
+            shuffle=shuffle,
+            seed=seed,
+            stratify=stratify,
+            msg=msg,
+            **writer_kwargs,
+        )
+    if cache is not None:
+        cache.store(cache_key, output_files)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,50 @@
+"""Write the FiNER-139 tag names by tag id for prepare_finer --tag-map"""
+
+from pathlib import Path
+
+import srsly
+import typer
+from wasabi import msg
+
+Arg = typer.Argument
+Opt = typer.Option
+
+
+def _datasets():
+    try:
+        import datasets
+    except ImportError:
+        raise ImportError(
+            "Reading the FiNER-139 tag names needs the 'datasets' package: "
+            "pip install datasets"
+        ) from None
+    return datasets
+
+
+def download_finer_tags(
+    # fmt: off
+    output_path: Path = Arg(..., help="Output JSON file with the tag names by tag id"),
+    dataset: str = Opt("nlpaueb/finer-139", "--dataset", "-d", help="Name of the dataset on the HF hub"),
+    # fmt: on
+) -> None:
+    """
+    Reads the names of the ner_tags ClassLabel from the features
+    in the metadata of the HF dataset, without downloading its
+    data or running code from the hub, and writes them as a JSON
+    list that prepare_finer --tag-map reads.
+    """
+    try:
+        builder = _datasets().load_dataset_builder(dataset)
+    except ImportError as e:
+        msg.fail(str(e), exits=1)
+    features = builder.info.features
+    if features is None or "ner_tags" not in features:
+        msg.fail(f"The metadata of {dataset} doesn't have the ner_tags feature", exits=1)
+    tags = features["ner_tags"].feature.names
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    srsly.write_json(output_path, tags)
+    msg.good(f"Saved {len(tags)} tag names of {dataset} to {output_path}")
+
+
+if __name__ == "__main__":
+    typer.run(download_finer_tags)
@@ -1,85 +1,323 @@
 import typer
+import numpy
 import spacy
-import os
 
-from typing import Set, Sequence, Optional
+from functools import partial
+from itertools import chain
+from multiprocessing import Pool
+from pathlib import Path
+from typing import Dict, Iterable, List, Set, Optional, Sequence, Tuple
 
 from tqdm import tqdm
 from wasabi import msg
-from spacy.tokens import DocBin, Doc
-from _util import info
+from spacy.strings import hash_string
+from spacy.tokens import DocBin, Doc, Span
+from _util import info, DatasetInfo, DocBinFormat, OutputCache, CACHE_SIZE
 
+# Which form of the spans is compared: the text as is, the
+# lowercased text or the NORMs of the tokens.
+MATCH_ATTRS = ("text", "lower", "norm")
+# MinHash settings, 'BANDS' x 'ROWS' hashes per signature.
+NGRAM = 3
+BANDS = 8
+ROWS = 4
+SIGNATURE_BATCH = 10000
+SEED = 0
 
-def _mark_as_missing(
-    docs: Sequence[Doc], seen: Set[str], mark_seen: bool = True, *, total: Optional[int] = None
-) -> DocBin:
+
+class _MinHashIndex:
+    """
+    Locality sensitive hashing index of MinHash signatures
+    over the character n-grams of the keys. Only keys that
+    share a band of their signature with a query are
+    compared to it, so lookups don't scan all the keys.
+    """
+
+    def __init__(self, keys: Sequence[Tuple[str, str]], threshold: float):
+        rng = numpy.random.default_rng(SEED)
+        max_hash = numpy.iinfo("uint64").max
+        num_perm = BANDS * ROWS
+        # Multiply-shift hashing with odd multipliers.
+        self.a = rng.integers(0, max_hash, num_perm, dtype="uint64", endpoint=True) | numpy.uint64(1)
+        self.b = rng.integers(0, max_hash, num_perm, dtype="uint64", endpoint=True)
+        self.threshold = threshold
+        self.labels = numpy.asarray([hash_string(label) for label, _ in keys], dtype="uint64")
+        self.signatures = self._signatures([text for _, text in keys])
+        band_hashes = self._band_hashes(self.signatures, self.labels)
+        self.order = numpy.argsort(band_hashes, axis=0, kind="stable")
+        self.band_hashes = numpy.take_along_axis(band_hashes, self.order, axis=0)
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    @staticmethod
+    def _shingles(text: str) -> Set[int]:
+        text = f" {text} "
+        if len(text) <= NGRAM:
+            return {hash_string(text)}
+        return {hash_string(text[i:i + NGRAM]) for i in range(len(text) - NGRAM + 1)}
+
+    def _signatures(self, texts: Sequence[str]) -> numpy.ndarray:
+        signatures = numpy.empty((len(texts), BANDS * ROWS), dtype="uint64")
+        for start in range(0, len(texts), SIGNATURE_BATCH):
+            shingles = [self._shingles(text) for text in texts[start:start + SIGNATURE_BATCH]]
+            lengths = numpy.asarray([len(shingle) for shingle in shingles])
+            hashes = numpy.fromiter(chain.from_iterable(shingles), dtype="uint64", count=lengths.sum())
+            permuted = (hashes[:, None] * self.a + self.b) >> numpy.uint64(32)
+            offsets = numpy.concatenate([[0], numpy.cumsum(lengths)[:-1]])
+            signatures[start:start + len(shingles)] = numpy.minimum.reduceat(permuted, offsets, axis=0)
+        return signatures
+
+    @staticmethod
+    def _band_hashes(signatures: numpy.ndarray, labels: numpy.ndarray) -> numpy.ndarray:
+        bands = signatures.reshape(len(signatures), BANDS, ROWS)
+        hashes = numpy.repeat(labels[:, None], BANDS, axis=1)
+        for row in range(ROWS):
+            hashes = hashes * numpy.uint64(1099511628211) + bands[:, :, row]
+        return hashes
+
+    def query(self, keys: Sequence[Tuple[str, str]]) -> List[bool]:
+        """
+        Whether each key has a near-duplicate in the index.
+        """
+        labels = numpy.asarray([hash_string(label) for label, _ in keys], dtype="uint64")
+        signatures = self._signatures([text for _, text in keys])
+        band_hashes = self._band_hashes(signatures, labels)
+        out = []
+        for i in range(len(keys)):
+            candidates = []
+            for band in range(BANDS):
+                column = self.band_hashes[:, band]
+                start = numpy.searchsorted(column, band_hashes[i, band], "left")
+                end = numpy.searchsorted(column, band_hashes[i, band], "right")
+                candidates.append(self.order[start:end, band])
+            candidates = numpy.unique(numpy.concatenate(candidates))
+            candidates = candidates[self.labels[candidates] == labels[i]]
+            similarity = (self.signatures[candidates] == signatures[i]).mean(axis=1)
+            out.append(bool((similarity >= self.threshold).any()))
+        return out
+
+
+class SeenMatcher:
+    """
+    Decides whether spans were seen in the training data.
+    Spans are compared by their text, lowercased text or
+    the NORMs of their tokens ('match'), optionally along
+    with their label. With a 'threshold' the spans without
+    an exact match are also looked up in a MinHash index of
+    the training spans, which matches them if their
+    estimated Jaccard similarity to a training span is at
+    least 'threshold'. Call 'build' after adding all
+    training spans.
+    """
+
+    def __init__(
+        self, match: str = "text", *, by_label: bool = False, threshold: Optional[float] = None
+    ):
+        if match not in MATCH_ATTRS:
+            raise ValueError(
+                f"'match' has to be one of {MATCH_ATTRS}, but found {match}"
+            )
+        self.match = match
+        self.by_label = by_label
+        self.threshold = threshold
+        self.keys: Set[Tuple[str, str]] = set()
+        self._index: Optional[_MinHashIndex] = None
+        self._fuzzy: Dict[Tuple[str, str], bool] = {}
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def key(self, span: Span) -> Tuple[str, str]:
+        if self.match == "text":
+            text = span.text
+        elif self.match == "lower":
+            text = " ".join(span.text.lower().split())
+        else:
+            text = " ".join(token.norm_ for token in span)
+        return (span.label_ if self.by_label else "", text)
+
+    def add(self, spans: Iterable[Span]) -> None:
+        self.keys.update(self.key(span) for span in spans)
+
+    def build(self) -> None:
+        if self.threshold is not None:
+            self._index = _MinHashIndex(sorted(self.keys), self.threshold)
+
+    def match_spans(self, spans: Iterable[Span]) -> List[bool]:
+        keys = [self.key(span) for span in spans]
+        seen = [key in self.keys for key in keys]
+        if self._index is not None:
+            unknown = list({key for key, is_seen in zip(keys, seen) if not is_seen} - self._fuzzy.keys())
+            if unknown:
+                self._fuzzy.update(zip(unknown, self._index.query(unknown)))
+            seen = [is_seen or self._fuzzy.get(key, False) for key, is_seen in zip(keys, seen)]
+        return seen
+
+
+def _get_spans(doc: Doc, spans_key: Optional[str]) -> Sequence[Span]:
+    return doc.ents if spans_key is None else doc.spans.get(spans_key, [])
+
+
+def _split_seen_unseen(
+    docs: Iterable[Doc],
+    matcher: SeenMatcher,
+    *,
+    spans_key: Optional[str] = None,
+    total: Optional[int] = None,
+    docbin_format: DocBinFormat = DocBinFormat(),
+    silent: bool = False
+) -> Tuple[DocBin, DocBin]:
+    """
+    Decodes each Doc once and returns a "seen" DocBin and an
+    "unseen" DocBin. For entities the ones of the other kind
+    are marked as missing, for the spans in
+    Doc.spans['spans_key'] they are removed from the group.
     """
-    Marks some of the ents in the input Docs as missing.
-    If 'mark_seen' is True then it marks entities in
-    'seen' as missing otherwise it marks the entities not in 'seen'
-    as missing.
+    seen_docbin = docbin_format.docbin()
+    unseen_docbin = docbin_format.docbin()
+    for doc in tqdm(docs, total=total, disable=silent):
+        spans = _get_spans(doc, spans_key)
+        if len(spans) != 0:
+            seen = matcher.match_spans(spans)
+            seen_doc = doc.copy()
+            if spans_key is None:
+                seen_ents = [ent for ent, is_seen in zip(spans, seen) if is_seen]
+                unseen_ents = [ent for ent, is_seen in zip(spans, seen) if not is_seen]
+                seen_doc.set_ents([], missing=unseen_ents, default="unmodified")
+                doc.set_ents([], missing=seen_ents, default="unmodified")
+            else:
+                group = seen_doc.spans[spans_key]
+                seen_doc.spans[spans_key] = [span for span, is_seen in zip(group, seen) if is_seen]
+                doc.spans[spans_key] = [span for span, is_seen in zip(spans, seen) if not is_seen]
+            seen_docbin.add(seen_doc)
+        else:
+            seen_docbin.add(doc)
+        unseen_docbin.add(doc)
+    return seen_docbin, unseen_docbin
+
+
+def _output_paths(dataset: DatasetInfo, output_dir: Path) -> List[Path]:
+    return [
+        output_dir / f"{dataset.source}-{split}-{seen}.spacy"
+        for seen in ("seen", "unseen")
+        for split in ("dev", "test")
+    ]
+
+
+def _process_dataset(
+    dataset: DatasetInfo,
+    *,
+    output_dir: Path,
+    spans_key: Optional[str] = None,
+    match: str = "text",
+    by_label: bool = False,
+    threshold: Optional[float] = None,
+    attrs_profile: str = "auto",
+    compression: str = "zlib",
+    silent: bool = False
+) -> Tuple[str, int, int]:
     """
-    new_docbin = DocBin()
-    for doc in tqdm(docs, total=total):
-        if len(doc.ents) != 0:
-            missing = []
-            for ent in doc.ents:
-                if not mark_seen ^ (ent.text in seen):
-                    missing.append(ent)
-            doc.set_ents([], missing=missing, default="unmodified")
-        new_docbin.add(doc)
-    return new_docbin
-
-
-def split_seen_unseen():
-    datasets = info("ner")
+    Writes the seen and unseen dev and test splits of
+    'dataset' and returns its source, the number of unique
+    training spans and the total number of them.
+    """
+    docbin_format = DocBinFormat.from_options(attrs_profile, compression, spans=spans_key is not None)
+    trainbin, devbin, testbin = dataset.load()
+    nlp = spacy.blank(dataset.lang)
+    matcher = SeenMatcher(match, by_label=by_label, threshold=threshold)
+    all_spans = 0
+    for doc in tqdm(trainbin.get_docs(nlp.vocab), total=len(trainbin), disable=silent):
+        spans = _get_spans(doc, spans_key)
+        all_spans += len(spans)
+        matcher.add(spans)
+    matcher.build()
+    seen_dev_path, seen_test_path, unseen_dev_path, unseen_test_path = _output_paths(dataset, output_dir)
+    seen_dev, unseen_dev = _split_seen_unseen(
+        devbin.get_docs(nlp.vocab), matcher, spans_key=spans_key, total=len(devbin),
+        docbin_format=docbin_format, silent=silent
+    )
+    docbin_format.to_disk(seen_dev, seen_dev_path)
+    docbin_format.to_disk(unseen_dev, unseen_dev_path)
+    seen_test, unseen_test = _split_seen_unseen(
+        testbin.get_docs(nlp.vocab), matcher, spans_key=spans_key, total=len(testbin),
+        docbin_format=docbin_format, silent=silent
+    )
+    docbin_format.to_disk(seen_test, seen_test_path)
+    docbin_format.to_disk(unseen_test, unseen_test_path)
+    return dataset.source, len(matcher), all_spans
+
+
+def split_seen_unseen(
+    # fmt: off
+    output_dir: Path = typer.Option("unseen", "--output-dir", "-o", help="Output directory for the seen and unseen splits"),
+    spans_key: Optional[str] = typer.Option(None, "--spans-key", "-sk", help="Split the spans in Doc.spans[spans_key] of the spancat corpora instead of the entities"),
+    match: str = typer.Option("text", "--match", "-m", help=f"Compare the spans by one of {MATCH_ATTRS}"),
+    by_label: bool = typer.Option(False, "--by-label", "-bl", help="Only count spans as seen with the same label"),
+    threshold: Optional[float] = typer.Option(None, "--threshold", "-t", help="Also count spans as seen that have an estimated Jaccard similarity of character n-grams of at least this much with a training span"),
+    attrs_profile: str = typer.Option("auto", "--attrs-profile", "-ap", help="Token attributes to store: 'minimal' (tokens and sentence starts), 'ner' (also the entities), 'full' (also tags, lemmas etc. and Doc.user_data) or 'auto' (minimal for Doc.spans, ner for Doc.ents)"),
+    compression: str = typer.Option("zlib", "--compression", "-cz", help="Compression of the .spacy files: 'zlib' or 'zstd', optionally with a level like 'zstd:19'"),
+    n_process: int = typer.Option(1, "--n-process", "-np", help="Number of datasets processed in parallel"),
+    cache_dir: Optional[Path] = typer.Option(None, "--cache-dir", "-cd", help="Cache the splits per dataset contents in this directory"),
+    cache_size: float = typer.Option(CACHE_SIZE, "--cache-size", help="Maximum size of the cache in GB"),
+    # fmt: on
+):
+    if match not in MATCH_ATTRS:
+        msg.fail(f"--match has to be one of {MATCH_ATTRS}, but found {match}", exits=1)
+    try:
+        DocBinFormat.from_options(attrs_profile, compression)
+    except ValueError as e:
+        msg.fail(str(e), exits=1)
+    datasets = info("ner" if spans_key is None else "spancat")
+    options = dict(
+        output_dir=output_dir,
+        spans_key=spans_key,
+        match=match,
+        by_label=by_label,
+        threshold=threshold,
+        attrs_profile=attrs_profile,
+        compression=compression,
+    )
+    output_dir.mkdir(parents=True, exist_ok=True)
+    cache = OutputCache(cache_dir, cache_size) if cache_dir is not None else None
+    todo = []
+    cache_keys = {}
     for _, dataset in datasets.items():
-        trainbin, devbin, testbin = dataset.load()
-        msg.good(f"Loaded data set {dataset.source}.")
-        nlp = spacy.blank(dataset.lang)
-        train_entities = set()
-        all_ents = 0
-        for doc in tqdm(trainbin.get_docs(nlp.vocab), total=len(trainbin)):
-            all_ents += len(doc.ents)
-            entities = {span.text for span in doc.ents}
-            train_entities.update(entities)
-        msg.good(
-            f"Collected {len(train_entities)} unique "
-            f"entities from a total of {all_ents}."
-        )
-        unseen_dev = _mark_as_missing(
-            docs=devbin.get_docs(nlp.vocab),
-            seen=train_entities,
-            mark_seen=True,
-            total=len(devbin),
-        )
-        seen_dev = _mark_as_missing(
-            docs=devbin.get_docs(nlp.vocab),
-            seen=train_entities,
-            mark_seen=False,
-            total=len(devbin),
-        )
-        unseen_test = _mark_as_missing(
-            docs=testbin.get_docs(nlp.vocab),
-            seen=train_entities,
-            mark_seen=True,
-            total=len(testbin),
-        )
-        seen_test = _mark_as_missing(
-            docs=testbin.get_docs(nlp.vocab),
-            seen=train_entities,
-            mark_seen=False,
-            total=len(testbin),
-        )
-        unseen_dev_path = os.path.join("unseen", f"{dataset.source}-dev-unseen.spacy")
-        unseen_test_path = os.path.join("unseen", f"{dataset.source}-test-unseen.spacy")
-        seen_dev_path = os.path.join("unseen", f"{dataset.source}-dev-seen.spacy")
-        seen_test_path = os.path.join("unseen", f"{dataset.source}-test-seen.spacy")
-        seen_dev.to_disk(seen_dev_path)
-        seen_test.to_disk(seen_test_path)
-        unseen_dev.to_disk(unseen_dev_path)
-        unseen_test.to_disk(unseen_test_path)
+        if cache is not None:
+            splits = [dataset.train.path, dataset.dev.path, dataset.test.path]
+            cache_key = cache.key(
+                splits,
+                lang=dataset.lang,
+                spans_key=spans_key,
+                match=match,
+                by_label=by_label,
+                threshold=threshold,
+                attrs_profile=attrs_profile,
+                compression=compression,
+            )
+            if cache.restore(cache_key, _output_paths(dataset, output_dir)):
+                msg.good(f"Restored data set {dataset.source} from the cache.")
+                continue
+            cache_keys[dataset.source] = cache_key
+        todo.append(dataset)
+    kind = "entities" if spans_key is None else "spans"
+
+    def report(results: Iterable[Tuple[str, int, int]]) -> None:
+        for source, n_unique, n_spans in results:
+            msg.good(
+                f"Split data set {source} using {n_unique} unique "
+                f"{kind} from a total of {n_spans}."
+            )
+            if cache is not None:
+                cache.store(cache_keys[source], _output_paths(datasets[source], output_dir))
 
+    if n_process > 1 and len(todo) > 1:
+        # Largest datasets first by the catalog's token counts.
+        todo.sort(key=lambda dataset: dataset.n_tokens, reverse=True)
+        with Pool(min(n_process, len(todo))) as pool:
+            report(pool.imap_unordered(partial(_process_dataset, silent=True, **options), todo))
+    else:
+        report(map(partial(_process_dataset, **options), todo))
 
 if __name__ == "__main__":
     typer.run(split_seen_unseen)
@@ -0,0 +1,241 @@
+"""Plan length-bucketed batches for a corpus and optionally re-pack it by length"""
+
+import shutil
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy
+import typer
+from wasabi import msg
+
+from ._util import DocBinFormat, LazyDocBin, SpanIndex, load_docbin, load_span_index
+from ._util import select_docs, span_index_path, stored_spans_key, write_doc_index
+
+Arg = typer.Argument
+Opt = typer.Option
+
+# Numbers of length buckets compared when --n-buckets isn't given.
+BUCKET_COUNTS = (1, 2, 4, 8, 16, 32)
+# Padding waste a recommended plan may have on top of the best one.
+WASTE_TOLERANCE = 0.02
+
+
+def length_bins(doc_length: numpy.ndarray) -> List[Tuple[str, int, int]]:
+    """
+    The number of docs and tokens in power of two length bins,
+    as (lengths, docs, tokens) rows.
+    """
+    bins = numpy.ceil(numpy.log2(numpy.maximum(doc_length, 1) + 1)).astype("int64") - 1
+    n_bins = int(bins.max()) + 1 if len(bins) else 0
+    docs = numpy.bincount(bins, minlength=n_bins)
+    tokens = numpy.bincount(bins, weights=doc_length, minlength=n_bins)
+    return [
+        (f"{2 ** b}-{2 ** (b + 1) - 1}" if b else "1", int(docs[b]), int(tokens[b]))
+        for b in range(n_bins) if docs[b]
+    ]
+
+
+def bucket_edges(doc_length: numpy.ndarray, n_buckets: int) -> numpy.ndarray:
+    """Length quantiles that split the docs into 'n_buckets' buckets."""
+    if n_buckets <= 1 or len(doc_length) == 0:
+        return numpy.zeros(0, dtype="int64")
+    quantiles = numpy.linspace(0, 1, n_buckets + 1)[1:-1]
+    return numpy.unique(numpy.quantile(doc_length, quantiles, method="higher"))
+
+
+def greedy_batches(lengths: numpy.ndarray, budget: int) -> numpy.ndarray:
+    """
+    The start of each batch when the docs are batched in order,
+    starting a new batch when the batch padded to its longest doc
+    would exceed 'budget' tokens. A longer doc gets its own batch.
+    """
+    starts = []
+    size = 0
+    longest = 0
+    for i, length in enumerate(lengths.tolist()):
+        longest_with = max(longest, length)
+        if size == 0 or (size + 1) * longest_with > budget:
+            starts.append(i)
+            size, longest = 1, length
+        else:
+            size, longest = size + 1, longest_with
+    return numpy.asarray(starts, dtype="int64")
+
+
+def plan_order(
+    doc_length: numpy.ndarray, n_buckets: int, budget: int, seed: Optional[int] = None
+) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Orders the docs so that batches come from one length bucket:
+    the docs are shuffled within their bucket and batched, and
+    the batches are shuffled. Returns the doc order and the start
+    of each batch in it.
+    """
+    rng = numpy.random.default_rng(seed)
+    bucket = numpy.searchsorted(bucket_edges(doc_length, n_buckets), doc_length, side="left")
+    shuffled = rng.permutation(len(doc_length))
+    order = shuffled[numpy.argsort(bucket[shuffled], kind="stable")]
+    bucket_starts = numpy.flatnonzero(numpy.diff(bucket[order], prepend=-1))
+    starts = numpy.concatenate([
+        greedy_batches(doc_length[order[start:end]], budget) + start
+        for start, end in zip(bucket_starts, numpy.append(bucket_starts[1:], len(order)))
+    ] + [numpy.zeros(0, dtype="int64")])
+    batches = numpy.split(order, starts[1:])
+    batches = [batches[i] for i in rng.permutation(len(starts))]
+    sizes = numpy.asarray([len(batch) for batch in batches], dtype="int64")
+    order = numpy.concatenate(batches + [numpy.zeros(0, dtype="int64")])
+    return order, numpy.cumsum(sizes) - sizes
+
+
+def batch_stats(lengths: numpy.ndarray, starts: numpy.ndarray) -> Dict[str, float]:
+    """Tokens, padded tokens and padding waste of the batches."""
+    if len(lengths) == 0:
+        return {"batches": 0, "docs": 0.0, "tokens": 0.0, "padded": 0.0, "waste": 0.0, "max_padded": 0}
+    sizes = numpy.diff(numpy.append(starts, len(lengths)))
+    tokens = numpy.add.reduceat(lengths, starts)
+    padded = numpy.maximum.reduceat(lengths, starts) * sizes
+    return {
+        "batches": len(starts),
+        "docs": float(sizes.mean()),
+        "tokens": float(tokens.mean()),
+        "padded": float(padded.mean()),
+        "waste": float(1 - tokens.sum() / max(padded.sum(), 1)),
+        "max_padded": int(padded.max()),
+    }
+
+
+def _repack(
+    corpus: LazyDocBin,
+    span_index: SpanIndex,
+    output_path: Path,
+    *,
+    n_buckets: int,
+    budget: int,
+    seed: Optional[int],
+    docbin_format: DocBinFormat,
+) -> None:
+    """
+    Writes the corpus with the docs of each shard in the order of
+    their planned batches, a shard at a time, with its sidecars.
+    """
+    sharded = corpus.path.is_dir()
+    if output_path.is_dir():
+        shutil.rmtree(output_path)
+    elif output_path.exists():
+        output_path.unlink()
+    if sharded:
+        output_path.mkdir(parents=True)
+    doc_ids = []
+    for shard_id, shard in enumerate(corpus.shards):
+        start, end = corpus.offsets[shard_id], corpus.offsets[shard_id + 1]
+        order, _ = plan_order(span_index.doc_length[start:end], n_buckets, budget, seed)
+        docbin = select_docs(load_docbin(shard), order)
+        shard_path = output_path / f"{shard_id:04d}.spacy" if sharded else output_path
+        docbin_format.to_disk(docbin, shard_path)
+        doc_ids.append(order + start)
+    repacked_index = span_index.select(numpy.concatenate(doc_ids))
+    repacked_index.to_disk(span_index_path(output_path))
+    write_doc_index(output_path, corpus.n_docs, repacked_index)
+
+
+def plan_batches(
+    # fmt: off
+    input_path: Path = Arg(..., help="Input .spacy file or directory of shards", exists=True),
+    batch_words: int = Opt(1000, "--batch-words", "-bw", help="Padded tokens per batch, like the batcher size in configs/spancat_default.cfg"),
+    n_buckets: int = Opt(0, "--n-buckets", "-nb", help="Number of length buckets, 0 to recommend one"),
+    seed: Optional[int] = Opt(None, "--seed", "-sd", help="Random seed for the order within buckets and of the batches"),
+    width: int = Opt(96, "--width", help="Width of the token vectors, for the memory estimate"),
+    layers: int = Opt(5, "--layers", help="Number of layers kept for the backward pass, for the memory estimate"),
+    output_path: Optional[Path] = Opt(None, "--output", "-o", help="Write the corpus re-packed in the order of the planned batches to this path"),
+    attrs_profile: str = Opt("auto", "--attrs-profile", "-ap", help="Token attributes to store: 'minimal' (tokens and sentence starts), 'ner' (also the entities), 'full' (also tags, lemmas etc. and Doc.user_data) or 'auto' (minimal for Doc.spans, ner for Doc.ents)"),
+    compression: str = Opt("zlib", "--compression", "-cz", help="Compression of the .spacy files: 'zlib' or 'zstd', optionally with a level like 'zstd:19'"),
+    # fmt: on
+) -> None:
+    """
+    Reports the doc length histogram of a corpus and the padding waste,
+    tokens per batch and activation memory of batches of at most
+    --batch-words padded tokens, in corpus order and with the docs
+    grouped into length buckets. The doc lengths come from the SpanIndex
+    sidecar, so no Docs are decoded. Without --n-buckets the plan with
+    the fewest buckets that wastes at most WASTE_TOLERANCE more than the
+    best one is recommended.
+
+    With --output the corpus is written in the order of the planned
+    batches, a shard at a time, so that batching it in order, for
+    example with spacy.batch_by_padded.v1, gives batches of similar
+    lengths. The batches are shuffled, so the order isn't a curriculum
+    from short to long docs. K-fold files aren't carried over.
+
+    spacy train only keeps the order of the corpus with
+    --training.max_epochs -1: with max_epochs >= 0, like the 1 in
+    configs/spancat_default.cfg, it shuffles all training examples
+    on each epoch, which undoes the re-packing.
+    """
+    corpus = LazyDocBin(input_path)
+    spans_key = stored_spans_key(input_path)
+    span_index = load_span_index(input_path, spans_key)
+    doc_length = span_index.doc_length.astype("int64")
+    msg.info(f"Found {len(corpus)} docs with {int(doc_length.sum())} tokens in {input_path}")
+    msg.table(
+        [(lengths, docs, f"{tokens / max(doc_length.sum(), 1):.1%}") for lengths, docs, tokens in length_bins(doc_length)],
+        header=("Length", "Docs", "Tokens"),
+        divider=True,
+    )
+    bytes_per_token = width * 4 * layers
+    bucketed = {}
+    for count in [n_buckets] if n_buckets else BUCKET_COUNTS:
+        order, starts = plan_order(doc_length, count, batch_words, seed)
+        bucketed[count] = batch_stats(doc_length[order], starts)
+    plans = {"corpus order": batch_stats(doc_length, greedy_batches(doc_length, batch_words))}
+    plans.update((f"{count} bucket{'s' if count > 1 else ''}", stats) for count, stats in bucketed.items())
+    msg.table(
+        [
+            (
+                name,
+                stats["batches"],
+                f"{stats['docs']:.1f}",
+                f"{stats['tokens']:.0f}",
+                f"{stats['padded']:.0f}",
+                f"{stats['waste']:.1%}",
+                f"{stats['max_padded'] * bytes_per_token / 2 ** 20:.1f}",
+            )
+            for name, stats in plans.items()
+        ],
+        header=("Plan", "Batches", "Docs", "Tokens", "Padded", "Waste", "Max MB"),
+        divider=True,
+    )
+    if not n_buckets:
+        best = min(stats["waste"] for stats in bucketed.values())
+        n_buckets = next(
+            count for count, stats in bucketed.items()
+            if stats["waste"] <= best + WASTE_TOLERANCE
+        )
+        msg.good(
+            f"Recommended: {n_buckets} length buckets with batches of "
+            f"{batch_words} padded tokens"
+        )
+    if output_path is not None:
+        try:
+            docbin_format = DocBinFormat.from_options(
+                attrs_profile, compression, spans=spans_key is not None
+            )
+        except ValueError as e:
+            msg.fail(str(e), exits=1)
+        _repack(
+            corpus,
+            span_index,
+            output_path,
+            n_buckets=n_buckets,
+            budget=batch_words,
+            seed=seed,
+            docbin_format=docbin_format,
+        )
+        msg.good(f"Saved the corpus re-packed into {n_buckets} length buckets to {output_path}")
+        msg.text(
+            "Train with --training.max_epochs -1 to keep this order, spacy train "
+            "shuffles the examples on each epoch otherwise"
+        )
+
+
+if __name__ == "__main__":
+    typer.run(plan_batches)
@@ -1,23 +1,205 @@
+"""Convert the FiNER-139 JSONL splits straight to .spacy corpora"""
+
+from functools import partial
+from multiprocessing import Pool
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
 import srsly
-import os
-import tqdm
+import typer
+from spacy.tokens import Doc
+from spacy.vocab import Vocab
+from wasabi import Printer, msg
+
+from ._util import CACHE_SIZE, CorpusWriter, DocBinFormat, OutputCache, corpus_output_path
+from ._util import sidecar_paths
+
+Arg = typer.Argument
+Opt = typer.Option
+
+ID = "finer"
+# The HF split names and the names of the corpora they're written to.
+SPLITS = {"train": "train", "validation": "dev", "test": "test"}
+
+
+def load_tag_map(path: Path) -> List[str]:
+    """
+    Reads the tag names by tag id from a JSON list, a JSON
+    object from tag id to name, or the dataset_infos.json of
+    the HF dataset (the names of the ner_tags ClassLabel).
+    """
+    data = srsly.read_json(path)
+    if isinstance(data, list):
+        return data
+    if all(isinstance(value, dict) for value in data.values()):
+        info = next(iter(data.values()))
+        return info["features"]["ner_tags"]["feature"]["names"]
+    tags = {int(tag_id): tag for tag_id, tag in data.items()}
+    return [tags[tag_id] for tag_id in range(len(tags))]
+
+
+def _fix_iob(tags: List[str]) -> List[str]:
+    """
+    Turns an I- tag that doesn't continue an entity of the same
+    label into a B- tag, as spaCy's IOB converters read it.
+    """
+    for i, tag in enumerate(tags):
+        if tag.startswith("I-") and (i == 0 or tags[i - 1][2:] != tag[2:]):
+            tags[i] = "B-" + tag[2:]
+    return tags
+
 
+def read_docs(path: Path, tag_map: Sequence[str], vocab: Vocab) -> Iterator[Doc]:
+    """
+    Streams the docs of a JSONL file with HF-style 'tokens'
+    and 'ner_tags' fields. Empty tokens are dropped with their
+    tags, and so are docs without tokens, like in the IOB files
+    the corpus used to be converted from.
+    """
+    for line_no, datum in enumerate(srsly.read_jsonl(path), 1):
+        tokens, tags = datum["tokens"], datum["ner_tags"]
+        if len(tokens) != len(tags):
+            raise ValueError(
+                f"{path}:{line_no}: {len(tokens)} tokens but {len(tags)} tags"
+            )
+        words = []
+        ents = []
+        for token, tag in zip(tokens, tags):
+            if token != "":
+                words.append(token)
+                ents.append(tag_map[tag])
+        if words:
+            yield Doc(vocab, words=words, ents=_fix_iob(ents))
 
-for split in ["train", "validation", "test"]:
-    path = os.path.join("temp", f"{split}.jsonl")
-    data = srsly.read_jsonl(path)
-    if split == "validation":
-        name = "dev"
+
+def _input_loc(split: str) -> Path:
+    """The corpus name the output files are named after."""
+    return Path(f"{ID}-{SPLITS[split]}.jsonl")
+
+
+def _output_files(
+    split: str, output_dir: Optional[Path], ents_output_dir: Optional[Path]
+) -> List[Path]:
+    output_files = [
+        corpus_output_path(path, _input_loc(split), is_dev=False)
+        for path in (ents_output_dir, output_dir)
+        if path is not None
+    ]
+    return output_files + [path for f in output_files for path in sidecar_paths(f)]
+
+
+def _prepare_split(
+    split_path: Tuple[str, Path],
+    *,
+    tag_map: Sequence[str],
+    output_dir: Optional[Path],
+    ents_output_dir: Optional[Path],
+    spans_key: str,
+    shard_size: int,
+    attrs_profile: str,
+    compression: str,
+    silent: bool,
+) -> Tuple[str, int]:
+    split, path = split_path
+    writer = CorpusWriter(
+        _input_loc(split),
+        False,
+        ents_dir=ents_output_dir,
+        spans_dir=output_dir,
+        spans_keys=[spans_key],
+        shard_size=shard_size,
+        attrs_profile=attrs_profile,
+        compression=compression,
+        msg=Printer(no_print=silent),
+    )
+    for doc in read_docs(path, tag_map, Vocab()):
+        writer.add(doc)
+    writer.close()
+    return split, writer.n_docs
+
+
+def prepare_finer(
+    # fmt: off
+    input_dir: Path = Arg(..., help="Directory with the train, validation and test JSONL files", exists=True, file_okay=False),
+    output_dir: Optional[Path] = Arg(None, help="Directory for the Doc.spans corpora"),
+    tag_map: Path = Opt(..., "--tag-map", "-tm", help="JSON file with the tag name of each tag id", exists=True, dir_okay=False),
+    ents_output_dir: Optional[Path] = Opt(None, "--ents-output-dir", "-eo", help="Also write the docs with Doc.ents to this directory"),
+    spans_key: str = Opt("sc", "--spans-key", "-sc", help="Spans key to use when storing entities"),
+    shard_size: int = Opt(0, "--shard-size", "-ss", help="Write the docs to shards of this many docs (0 to disable)"),
+    attrs_profile: str = Opt("auto", "--attrs-profile", "-ap", help="Token attributes to store: 'minimal' (tokens and sentence starts), 'ner' (also the entities), 'full' (also tags, lemmas etc. and Doc.user_data) or 'auto' (minimal for Doc.spans, ner for Doc.ents)"),
+    compression: str = Opt("zlib", "--compression", "-cz", help="Compression of the .spacy files: 'zlib' or 'zstd', optionally with a level like 'zstd:19'"),
+    n_process: int = Opt(1, "--n-process", "-np", help="Number of splits to convert in parallel"),
+    cache_dir: Optional[Path] = Opt(None, "--cache-dir", "-cd", help="Cache the output per input file contents and options in this directory"),
+    cache_size: float = Opt(CACHE_SIZE, "--cache-size", help="Maximum size of the cache in GB"),
+    silent: bool = Opt(False, "--silent", help="Only print the summary of each split")
+    # fmt: on
+) -> None:
+    """
+    Converts the HF-style 'tokens'/'ner_tags' JSONL splits of FiNER-139
+    directly into DocBin corpora named finer-{train,dev,test}.spacy,
+    with the tag ids mapped to their names with --tag-map. The docs
+    are streamed from the JSONL to the corpora, with a process per
+    split if --n-process is more than 1. The corpora are written with
+    --attrs-profile and --compression like in convert_to_spans.
+    """
+    if output_dir is None and ents_output_dir is None:
+        msg.fail("Expected an output_dir, an --ents-output-dir or both", exits=1)
+    try:
+        DocBinFormat.from_options(attrs_profile, compression)
+    except ValueError as e:
+        msg.fail(str(e), exits=1)
+    for path in (output_dir, ents_output_dir):
+        if path is not None:
+            path.mkdir(parents=True, exist_ok=True)
+    tags = load_tag_map(tag_map)
+    msg.info(f"Found {len(tags)} tags in {tag_map}")
+    splits: Dict[str, Path] = {}
+    for split in SPLITS:
+        path = input_dir / f"{split}.jsonl"
+        if not path.is_file():
+            msg.fail(f"Input file not found: {path}", exits=1)
+        splits[split] = path
+    cache_keys: Dict[str, str] = {}
+    if cache_dir is not None:
+        cache = OutputCache(cache_dir, cache_size)
+        for split, path in list(splits.items()):
+            key = cache.key(
+                [path, tag_map],
+                spans_dir=output_dir is not None,
+                ents_dir=ents_output_dir is not None,
+                spans_key=spans_key,
+                shard_size=shard_size,
+                attrs_profile=attrs_profile,
+                compression=compression,
+            )
+            outputs = _output_files(split, output_dir, ents_output_dir)
+            if cache.restore(key, outputs):
+                msg.good(f"Restored the {SPLITS[split]} split from the cache")
+                del splits[split]
+            else:
+                cache_keys[split] = key
+    prepare_split = partial(
+        _prepare_split,
+        tag_map=tags,
+        output_dir=output_dir,
+        ents_output_dir=ents_output_dir,
+        spans_key=spans_key,
+        shard_size=shard_size,
+        attrs_profile=attrs_profile,
+        compression=compression,
+        silent=silent,
+    )
+    if n_process > 1 and len(splits) > 1:
+        with Pool(min(n_process, len(splits))) as pool:
+            results = list(pool.imap_unordered(prepare_split, splits.items()))
     else:
-        name = split
-    outpath = os.path.join("assets/", f"finer-{name}.iob")
-    with open(outpath, "w") as fiob:
-        for datum in tqdm.tqdm(data):
-            tokens, tags = datum["tokens"], datum["ner_tags"]
-            assert len(tokens) == len(tags)
-            for token, tag in zip(tokens, tags):
-                if token == "":
-                    continue
-                line = f"{token} \t {tag}\n"
-                fiob.write(line)
-            fiob.write("\n")
+        results = [prepare_split(item) for item in splits.items()]
+    for split, n_docs in results:
+        msg.good(f"Converted the {SPLITS[split]} split ({n_docs} docs)")
+        if split in cache_keys:
+            outputs = _output_files(split, output_dir, ents_output_dir)
+            cache.store(cache_keys[split], outputs)
+
+
+if __name__ == "__main__":
+    typer.run(prepare_finer)
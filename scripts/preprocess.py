@@ -1,5 +1,9 @@
+import os
+from functools import partial
+from multiprocessing import Pool
 from pathlib import Path
 from string import digits
+from typing import Iterable, Iterator, List, Optional, Tuple
 
 import typer
 from wasabi import msg
@@ -7,29 +11,93 @@ from wasabi import msg
 Arg = typer.Argument
 Opt = typer.Option
 
+DOCSTART_LINES = {"-DOCSTART-\tO\n", "-DOCSTART- -DOCSTART- O\n"}
+DOCSTART = "-DOCSTART- -X- O O\n"
+# Size of the read and write buffers in bytes.
+BUFFER_SIZE = 1 << 20
+
+
+def canonicalize_line(line: str, strip_digits: bool = False) -> str:
+    """
+    Canonicalizes a single line of a ConLL file: strips the
+    leading token index if 'strip_digits' is set, normalizes
+    the -DOCSTART- lines and turns lines with only a tab into
+    empty lines.
+    """
+    if strip_digits and line != "\n":
+        line = line.lstrip(digits)[1:]
+    if line in DOCSTART_LINES:
+        return DOCSTART
+    elif line == "\t\n":
+        return "\n"
+    return line
+
+
+def canonicalize(lines: Iterable[str], *, strip_digits: bool = False) -> Iterator[str]:
+    for line in lines:
+        yield canonicalize_line(line, strip_digits)
+
+
+def _preprocess_file(paths: Tuple[Path, Path], *, strip_digits: bool) -> Path:
+    """
+    Streams 'input_path' through canonicalize into a temporary
+    file next to 'output_path' and moves it into place, so the
+    output is never half-written and can be the input itself.
+    """
+    input_path, output_path = paths
+    tmp_path = output_path.parent / f".{output_path.name}.tmp"
+    try:
+        with input_path.open(buffering=BUFFER_SIZE) as src:
+            with tmp_path.open("w", buffering=BUFFER_SIZE) as dest:
+                dest.writelines(canonicalize(src, strip_digits=strip_digits))
+        os.replace(tmp_path, output_path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+    return output_path
+
 
 def preprocess(
-        input_path: Path,
-        output_path: Path,
-        *,
-        strip_digits: bool = False
+    # fmt: off
+    input_paths: List[Path] = Arg(..., help="Input files, or an input and an output file without --output-dir"),
+    output_dir: Optional[Path] = Opt(None, "--output-dir", "-o", help="Write the preprocessed files to this directory"),
+    remove_prefix: str = Opt("", "--remove-prefix", "-rp", help="Remove this prefix from the names of the output files"),
+    strip_digits: bool = Opt(False, "--strip-digits", help="Strip the token index at the start of each line"),
+    n_process: int = Opt(1, "--n-process", "-np", help="Number of files to preprocess in parallel"),
+    # fmt: on
 ) -> None:
     """
     Helper function to canonicalize all datasets into the same ConLL format.
+
+    Without --output-dir it takes an input and an output file, which
+    can be the same. With --output-dir it takes any number of input
+    files and preprocesses them in a pool of --n-process processes.
+    Files are streamed line by line and written atomically.
     """
-    with input_path.open() as f:
-        lines = f.readlines()
-    with output_path.open("w") as f:
-        for i, line in enumerate(lines):
-            new_line = line
-            if strip_digits:
-                new_line = line if line == "\n" else line.lstrip(digits)[1:]
-            if new_line in {"-DOCSTART-\tO\n", "-DOCSTART- -DOCSTART- O\n"}:
-                new_line = "-DOCSTART- -X- O O\n"
-            elif new_line == "\t\n":
-                new_line = "\n"
-            f.write(new_line)
-    msg.good(f"Saved preprocessed data to {output_path}")
+    if output_dir is None:
+        if len(input_paths) != 2:
+            msg.fail("Expected an input and an output file without --output-dir", exits=1)
+        pairs = [(input_paths[0], input_paths[1])]
+    else:
+        output_dir.mkdir(parents=True, exist_ok=True)
+        pairs = []
+        for input_path in input_paths:
+            name = input_path.name
+            if remove_prefix and name.startswith(remove_prefix):
+                name = name[len(remove_prefix):]
+            pairs.append((input_path, output_dir / name))
+    for input_path, _ in pairs:
+        if not input_path.is_file():
+            msg.fail(f"Input file not found: {input_path}", exits=1)
+    preprocess_file = partial(_preprocess_file, strip_digits=strip_digits)
+    if n_process > 1 and len(pairs) > 1:
+        with Pool(min(n_process, len(pairs))) as pool:
+            for output_path in pool.imap_unordered(preprocess_file, pairs):
+                msg.good(f"Saved preprocessed data to {output_path}")
+    else:
+        for pair in pairs:
+            output_path = preprocess_file(pair)
+            msg.good(f"Saved preprocessed data to {output_path}")
 
 
 if __name__ == "__main__":
@@ -1,40 +1,165 @@
 """Split a spaCy-formatted file into train, dev, and test partitions"""
 
 from pathlib import Path
-from typing import Tuple, Optional, Any, List, Sequence
+from typing import Tuple, Optional, List, Sequence
 
 import random
+import shutil
+import hashlib
 import typer
-import spacy
+import numpy
+import srsly
 from math import ceil
+from spacy.attrs import ORTH
 from spacy.tokens import DocBin
+from spacy.vocab import Vocab
 from wasabi import msg
 
+from ._util import CACHE_SIZE, DocBinFormat, OutputCache, LazyDocBin, SpanIndex, select_docs
+from ._util import cached_span_index, load_span_index, sidecar_paths, span_index_path
+from ._util import fold_path, load_docbin, write_doc_index, write_folds
+from ._split import kfold_split, stratified_split
+
 Arg = typer.Argument
 Opt = typer.Option
 
+SPLITS = ("train", "dev", "test")
+SPLIT_BY = ("index", "hash", "stratify")
+
 
 def _train_dev_test_split(
-    data: Sequence[Any],
+    n_samples: int,
     train_size,
     dev_size: float,
     test_size: float,
     shuffle: Optional[bool] = False,
     seed: Optional[int] = None,
-) -> Tuple[List[Any], List[Any], List[Any]]:
+) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Assigns the indices 0..n_samples to the splits in the
+    same way as shuffling and cutting a list of the docs
+    would. Returns the split of each index (0: train,
+    1: dev, 2: test) and its position in the output.
+    """
+    order = list(range(n_samples))
     if shuffle:
         if not seed:
             raise ValueError("Must provide 'seed' when 'shuffle = True'")
         rng = random.Random(seed)
-        rng.shuffle(data)
-    n_samples = len(data)
+        rng.shuffle(order)
     n_test = ceil(test_size * n_samples)
     n_dev = ceil(dev_size * n_samples)
     n_train = n_samples - (n_test + n_dev)
-    train = data[:n_train]
-    dev = data[n_train:n_train+n_dev]
-    test = data[n_train+n_dev:]
-    return train, dev, test
+    order = numpy.asarray(order, dtype="int64")
+    splits = numpy.zeros(n_samples, dtype="int8")
+    splits[order[n_train:n_train+n_dev]] = 1
+    splits[order[n_train+n_dev:]] = 2
+    ranks = numpy.empty(n_samples, dtype="int64")
+    ranks[order] = numpy.arange(n_samples)
+    return splits, ranks
+
+
+def _doc_hashes(docbin: DocBin, seed: Optional[int] = None) -> numpy.ndarray:
+    """
+    A stable hash of the serialized tokens and whitespace
+    of each doc in 'docbin', which is the same for docs
+    with the same text.
+    """
+    orth = docbin.attrs.index(ORTH)
+    salt = str(seed or 0).encode("utf8")
+    hashes = numpy.empty(len(docbin), dtype="uint64")
+    for i, (tokens, spaces) in enumerate(zip(docbin.tokens, docbin.spaces)):
+        hasher = hashlib.blake2b(salt, digest_size=8)
+        hasher.update(numpy.ascontiguousarray(tokens[:, orth]).tobytes())
+        hasher.update(numpy.ascontiguousarray(spaces).tobytes())
+        hashes[i] = int.from_bytes(hasher.digest(), "little")
+    return hashes
+
+
+def _hash_split(
+    docbin: DocBin, split_size: Sequence[float], seed: Optional[int] = None
+) -> numpy.ndarray:
+    """
+    Assigns each doc in 'docbin' to a split by its stable
+    hash, so the same text always ends up in the same split.
+    """
+    fractions = _doc_hashes(docbin, seed) / 2 ** 64
+    bounds = numpy.cumsum(split_size)[:-1]
+    return numpy.searchsorted(bounds, fractions, side="right").astype("int8")
+
+
+def _text_groups(corpus: LazyDocBin) -> numpy.ndarray:
+    return numpy.concatenate([
+        _doc_hashes(load_docbin(shard)) for shard in corpus.shards
+    ])
+
+
+def _write_kfold(
+    corpus: LazyDocBin,
+    span_index: Optional[SpanIndex],
+    corpus_path: Path,
+    n_folds: int,
+    *,
+    split_by: str,
+    shuffle: bool,
+    seed: Optional[int],
+    group_by_text: bool,
+) -> None:
+    """
+    Writes the corpus once to 'corpus_path', unless it's
+    already there, and the held out doc ids of each fold
+    next to it.
+    """
+    sizes = [1 / n_folds] * n_folds
+    if split_by == "index":
+        folds = kfold_split(len(corpus), n_folds, shuffle=shuffle, seed=seed)
+    elif split_by == "hash":
+        folds = numpy.concatenate([
+            _hash_split(load_docbin(shard), sizes, seed) for shard in corpus.shards
+        ])
+    else:
+        msg.info(f"Stratifying by {len(span_index.labels)} span labels")
+        folds = stratified_split(
+            len(corpus),
+            span_index.doc_id,
+            span_index.label,
+            sizes,
+            groups=_text_groups(corpus) if group_by_text else None,
+            seed=seed,
+        )
+    if not corpus_path.exists() or not corpus_path.samefile(corpus.path):
+        for src, dest in zip(
+            [corpus.path, *sidecar_paths(corpus.path)],
+            [corpus_path, *sidecar_paths(corpus_path)]
+        ):
+            if dest.is_dir():
+                shutil.rmtree(dest)
+            elif dest.exists():
+                dest.unlink()
+            if not src.exists():
+                continue
+            if src.is_dir():
+                shutil.copytree(src, dest)
+            else:
+                shutil.copy2(src, dest)
+    write_folds(corpus_path, folds)
+    fold_sizes = ", ".join(map(str, numpy.bincount(folds, minlength=n_folds)))
+    msg.good(f"Saved {n_folds} folds ({fold_sizes}) of {corpus_path}")
+
+
+def _find_spans_key(corpus: LazyDocBin) -> Optional[str]:
+    """
+    The key of the first span group in the corpus, which
+    only decodes the first Doc that has span groups.
+    """
+    vocab = Vocab()
+    for shard in corpus.shards:
+        docbin = load_docbin(shard)
+        for i, span_groups in enumerate(docbin.span_groups):
+            if srsly.msgpack_loads(span_groups):
+                doc = next(select_docs(docbin, [i]).get_docs(vocab))
+                return next(iter(doc.spans), None)
+    return None
 
 
 def split_docs(
@@ -43,38 +168,161 @@ def split_docs(
     output_dir: Path,
     split_size: Tuple[float, float, float] = Arg((0.8, 0.1, 0.1), help="Split sizes for train/dev/test respectively"),
     shuffle: bool = Opt(False, "--shuffle", "-sf", help="Shuffle the dataset before splitting"),
-    seed: Optional[int] = Opt(None, "--seed", "-sd", help="Random seed for shuffling the data")
+    seed: Optional[int] = Opt(None, "--seed", "-sd", help="Random seed for shuffling the data"),
+    split_by: str = Opt("index", "--split-by", "-sb", help="Split by the (shuffled) doc 'index', by a stable 'hash' of the doc text or 'stratify' by the span labels"),
+    group_by_text: bool = Opt(False, "--group-by-text", "-gt", help="Keep docs with the same text in the same split when stratifying"),
+    n_folds: int = Opt(0, "--n-folds", "-k", help="Instead of train/dev/test splits, write the corpus once with the held out docs of this many folds"),
+    attrs_profile: str = Opt("auto", "--attrs-profile", "-ap", help="Token attributes to store: 'minimal' (tokens and sentence starts), 'ner' (also the entities), 'full' (also tags, lemmas etc. and Doc.user_data) or 'auto' (minimal for Doc.spans, ner for Doc.ents)"),
+    compression: str = Opt("zlib", "--compression", "-cz", help="Compression of the .spacy files: 'zlib' or 'zstd', optionally with a level like 'zstd:19'"),
+    cache_dir: Optional[Path] = Opt(None, "--cache-dir", "-cd", help="Cache the output per input file contents and options in this directory"),
+    cache_size: float = Opt(CACHE_SIZE, "--cache-size", help="Maximum size of the cache in GB")
     # fmt: on
 ):
+    """
+    Splits the corpus at 'input_path' a shard at a time and
+    copies the serialized docs to the splits without creating
+    Docs. A sharded corpus is written as sharded splits with
+    one shard per input shard.
+
+    With --n-folds the corpus is written to output_dir only once
+    and each fold is a small file with the ids of its held out
+    docs, read by the span_labeling.FoldCorpus.v1 reader in _util.
+    """
     if sum(split_size) != 1.0:
         msg.fail(
             "Split sizes for train, dev, and test should sum up to 1.0 "
             f"({' + '.join(map(str, split_size))} != 1.0)",
             exits=1,
         )
+    if split_by not in SPLIT_BY:
+        msg.fail(f"--split-by has to be one of {SPLIT_BY}, but found {split_by}", exits=1)
+    try:
+        DocBinFormat.from_options(attrs_profile, compression)
+    except ValueError as e:
+        msg.fail(str(e), exits=1)
+    output_paths = [
+        output_dir / f"{input_path.stem}-{dataset}.spacy"
+        for dataset in SPLITS
+    ]
+    cached_paths = output_paths + [
+        path for output_path in output_paths for path in sidecar_paths(output_path)
+    ]
+    corpus_path = output_dir / input_path.name
+    if n_folds:
+        cached_paths = [corpus_path, *sidecar_paths(corpus_path)]
+        cached_paths += [fold_path(corpus_path, fold) for fold in range(n_folds)]
+    if cache_dir is not None:
+        cache = OutputCache(cache_dir, cache_size)
+        cache_key = cache.key(
+            [input_path],
+            split_size=split_size,
+            shuffle=shuffle,
+            seed=seed,
+            split_by=split_by,
+            group_by_text=group_by_text,
+            n_folds=n_folds,
+            attrs_profile=attrs_profile,
+            compression=compression,
+        )
+        if cache.restore(cache_key, cached_paths):
+            msg.good(f"Restored the splits of {input_path} from the cache")
+            return
 
-    nlp = spacy.blank("xx")
-    db = DocBin().from_disk(input_path)
-    docs = list(db.get_docs(nlp.vocab))
-    msg.info(f"Found {len(docs)} docs in {input_path}")
+    corpus = LazyDocBin(input_path)
+    msg.info(f"Found {len(corpus)} docs in {input_path}")
+    # Index the spans under the first spans key, or the ents for NER corpora.
+    # Only stratifying needs the SpanIndex, otherwise it's only carried over
+    # to the splits if the corpus already has an up to date one.
+    spans_key = _find_spans_key(corpus)
+    if split_by == "stratify":
+        span_index = load_span_index(input_path, spans_key)
+    else:
+        span_index = cached_span_index(input_path, spans_key)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if n_folds:
+        _write_kfold(
+            corpus,
+            span_index,
+            corpus_path,
+            n_folds,
+            split_by=split_by,
+            shuffle=shuffle,
+            seed=seed,
+            group_by_text=group_by_text,
+        )
+        if cache_dir is not None:
+            cache.store(cache_key, cached_paths)
+        return
 
+    docbin_format = DocBinFormat.from_options(
+        attrs_profile, compression, spans=spans_key is not None
+    )
     train_size, dev_size, test_size = split_size
     msg.info(f"Splitting docs using sizes: {split_size}")
-    train, dev, test = _train_dev_test_split(
-        docs, train_size, dev_size, test_size, shuffle, seed
-    )
-    datasets = {"train": train, "dev": dev, "test": test}
+    if split_by == "index":
+        splits, ranks = _train_dev_test_split(
+            len(corpus), train_size, dev_size, test_size, shuffle, seed
+        )
+    elif split_by == "stratify":
+        msg.info(f"Stratifying by {len(span_index.labels)} span labels")
+        groups = _text_groups(corpus) if group_by_text else None
+        splits = stratified_split(
+            len(corpus),
+            span_index.doc_id,
+            span_index.label,
+            split_size,
+            groups=groups,
+            seed=seed,
+        )
+        ranks = numpy.arange(len(corpus))
+    sharded = input_path.is_dir()
+    for output_path in output_paths:
+        if output_path.is_dir():
+            shutil.rmtree(output_path)
+        elif output_path.exists():
+            output_path.unlink()
+        if sharded:
+            output_path.mkdir(parents=True)
+    doc_ids: List[List[numpy.ndarray]] = [[] for _ in SPLITS]
+    shard_sizes: List[List[int]] = [[] for _ in SPLITS]
+    for shard_id, shard in enumerate(corpus.shards):
+        docbin = load_docbin(shard)
+        start = corpus.offsets[shard_id]
+        global_ids = numpy.arange(start, start + len(docbin))
+        if split_by in ("index", "stratify"):
+            # Keep the order of the shuffled docs.
+            global_ids = global_ids[numpy.argsort(ranks[global_ids], kind="stable")]
+            shard_splits = splits[global_ids]
+        else:
+            shard_splits = _hash_split(docbin, split_size, seed)
+        for split_id, output_path in enumerate(output_paths):
+            selected = global_ids[shard_splits == split_id]
+            split_docbin = select_docs(docbin, selected - start)
+            if sharded:
+                docbin_format.to_disk(split_docbin, output_path / f"{shard_id:04d}.spacy")
+            else:
+                docbin_format.to_disk(split_docbin, output_path)
+            doc_ids[split_id].append(selected)
+            shard_sizes[split_id].append(len(selected))
 
+    n_docs = [sum(sizes) for sizes in shard_sizes]
     msg.text(
-        f"Done splitting the train ({len(train)}), dev ({len(dev)}), "
-        f" and test ({len(test)}) datasets!"
+        f"Done splitting the train ({n_docs[0]}), dev ({n_docs[1]}), "
+        f" and test ({n_docs[2]}) datasets!"
     )
-
-    for dataset, docs in datasets.items():
-        output_path = output_dir / f"{input_path.stem}-{dataset}.spacy"
-        db_new = DocBin(docs=docs)
-        db_new.to_disk(output_path)
-        msg.good(f"Saved {dataset} ({len(docs)}) dataset to {output_path}")
+    for split_id, (output_path, dataset) in enumerate(zip(output_paths, SPLITS)):
+        index_path = span_index_path(output_path)
+        if span_index is not None:
+            split_index = span_index.select(numpy.concatenate(doc_ids[split_id]))
+            split_index.to_disk(index_path)
+        else:
+            split_index = None
+            if index_path.exists():
+                index_path.unlink()
+        write_doc_index(output_path, shard_sizes[split_id], split_index)
+        msg.good(f"Saved {dataset} ({n_docs[split_id]}) dataset to {output_path}")
+    if cache_dir is not None:
+        cache.store(cache_key, cached_paths)
 
 
 if __name__ == "__main__":
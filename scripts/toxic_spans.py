@@ -1,13 +1,20 @@
-import ast
+import re
 import csv
 import random
+from collections import Counter
 from pathlib import Path
-from typing import Optional
+from typing import Dict, List, Optional, Sequence, Tuple
 
+import numpy
 import spacy
 import typer
-from spacy.tokens import Doc, DocBin, SpanGroup
-from wasabi import msg
+from spacy.attrs import IDX, LENGTH
+from spacy.tokens import Doc, Span, SpanGroup
+from spacy.util import filter_spans
+from wasabi import Printer, msg
+
+from ._util import DocBinFormat, DocBinWriter, SpanIndex, write_folds
+from ._split import kfold_split, stratified_split
 
 Arg = typer.Argument
 Opt = typer.Option
@@ -16,6 +23,94 @@ ID = "toxic-spans"
 TRAIN_SIZE = 0.8
 DEV_SIZE = 0.1
 TEST_SIZE = 0.1
+BATCH_SIZE = 1000
+
+# The "probability" and "type" columns hold Python literals, these
+# patterns parse them without ast.literal_eval.
+_NUMBER = r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?"
+_SPAN_PROB = re.compile(rf"\(\s*(\d+)\s*,\s*(\d+)\s*\)\s*:\s*({_NUMBER})")
+_SPAN_PROBS = re.compile(rf"\{{\s*(?:{_SPAN_PROB.pattern}\s*(?:,\s*{_SPAN_PROB.pattern}\s*)*,?)?\s*\}}")
+_LABEL = re.compile(r"'([^'\\]*)'|\"([^\"\\]*)\"")
+_LABELS = re.compile(rf"\[\s*(?:(?:{_LABEL.pattern})\s*(?:,\s*(?:{_LABEL.pattern})\s*)*,?)?\s*\]")
+
+
+def _parse_span_probs(value: str) -> Dict[Tuple[int, int], float]:
+    """
+    Parses the "probability" column, a dict literal like
+    "{(0, 5): 0.66, (10, 14): 1.0}", without evaluating it.
+    """
+    if not _SPAN_PROBS.fullmatch(value):
+        raise ValueError(f"Invalid span probabilities: {value}")
+    return {
+        (int(start), int(end)): float(prob)
+        for start, end, prob in _SPAN_PROB.findall(value)
+    }
+
+
+def _parse_labels(value: str) -> List[str]:
+    """
+    Parses the "type" column, a list literal of strings like
+    "['insult', 'threat']", without evaluating it.
+    """
+    if not _LABELS.fullmatch(value):
+        raise ValueError(f"Invalid span types: {value}")
+    return [single or double for single, double in _LABEL.findall(value)]
+
+
+def _align_spans(
+    doc: Doc, offsets: Sequence[Tuple[Tuple[int, int], str]], counts: Counter
+) -> List[Span]:
+    """
+    Aligns the character offsets to tokens like Doc.char_span
+    with alignment_mode="expand", but for all spans of the doc
+    at once with the token start and end offsets. Spans that
+    don't cover any token are dropped instead of becoming empty
+    spans. 'counts' tracks how many spans matched the token
+    boundaries exactly, were expanded to cover partial tokens,
+    were trimmed to tokens at whitespace or were dropped.
+    """
+    if not offsets:
+        return []
+    token_offsets = doc.to_array([IDX, LENGTH]).astype("int64")
+    token_starts = token_offsets[:, 0]
+    token_ends = token_starts + token_offsets[:, 1]
+    chars = numpy.asarray([span for span, _ in offsets], dtype="int64").reshape(-1, 2)
+    chars = numpy.minimum(chars, len(doc.text))
+    starts = numpy.searchsorted(token_ends, chars[:, 0], side="right")
+    ends = numpy.searchsorted(token_starts, chars[:, 1], side="left")
+    spans = []
+    for (_, label), (char_start, char_end), start, end in zip(offsets, chars, starts, ends):
+        if start >= end:
+            counts["dropped"] += 1
+            continue
+        if token_starts[start] < char_start or token_ends[end - 1] > char_end:
+            counts["expanded"] += 1
+        elif token_starts[start] != char_start or token_ends[end - 1] != char_end:
+            counts["trimmed"] += 1
+        else:
+            counts["exact"] += 1
+        spans.append(Span(doc, int(start), int(end), label=label))
+    return spans
+
+
+def _write_corpus(
+    output_file: Path,
+    docs: Sequence[Doc],
+    *,
+    spans_key: Optional[str],
+    shard_size: int,
+    docbin_format: DocBinFormat,
+) -> None:
+    writer = DocBinWriter(
+        output_file,
+        shard_size=shard_size,
+        spans_key=spans_key,
+        docbin_format=docbin_format,
+        msg=Printer(no_print=True),
+    )
+    for doc in docs:
+        writer.add(doc)
+    writer.close()
 
 
 def convert_toxic_spans(
@@ -25,7 +120,13 @@ def convert_toxic_spans(
     spans_key: str = Opt("sc", "--spans-key", help="Spans key to use when storing entities"),
     use_ents: bool = Opt(False, "--use-ents", "-e", help="Use Doc.ents, don't transfer to Doc.spans"),
     shuffle: bool = Opt(False, "--shuffle", "-sf", help="Shuffle the dataset before splitting"),
-    seed: Optional[int] = Opt(None, "--seed", "-sd", help="Random seed for shuffling the data")
+    seed: Optional[int] = Opt(None, "--seed", "-sd", help="Random seed for shuffling the data"),
+    stratify: bool = Opt(False, "--stratify", "-st", help="Balance the span labels over the train, dev and test split"),
+    n_folds: int = Opt(0, "--n-folds", "-k", help="Write all docs once with the held out docs of this many folds instead of a train/dev/test split"),
+    n_process: int = Opt(1, "--n-process", "-np", help="Number of processes to tokenize the posts with"),
+    shard_size: int = Opt(0, "--shard-size", "-ss", help="Write the docs to shards of this many docs (0 to disable)"),
+    attrs_profile: str = Opt("auto", "--attrs-profile", "-ap", help="Token attributes to store: 'minimal' (tokens and sentence starts), 'ner' (also the entities), 'full' (also tags, lemmas etc. and Doc.user_data) or 'auto' (minimal for Doc.spans, ner for Doc.ents)"),
+    compression: str = Opt("zlib", "--compression", "-cz", help="Compression of the .spacy files: 'zlib' or 'zstd', optionally with a level like 'zstd:19'")
     # fmt: on
 ):
     """Convert the examples from the ToxicSpans dataset into the spaCy format
@@ -33,61 +134,102 @@ def convert_toxic_spans(
     For this experiment, we will be following the 80/10/10 train-dev-test split
     done in the paper: https://aclanthology.org/2022.acl-long.259/
     """
+    try:
+        docbin_format = DocBinFormat.from_options(attrs_profile, compression, spans=not use_ents)
+    except ValueError as e:
+        msg.fail(str(e), exits=1)
     with input_path.open(mode="r") as f:
         csv_reader = csv.DictReader(f)
         examples = []
-        for row in csv_reader:
-            examples.append(row)
+        for i, row in enumerate(csv_reader):
+            try:
+                span_probs = _parse_span_probs(row["probability"])
+                labels = _parse_labels(row["type"])
+            except ValueError as e:
+                msg.fail(f"Can't parse row {i + 1} of {input_path}: {e}", exits=1)
+            # In toxic-spans, we only have labels for spans where the annotator score
+            # is > 0.5 (i.e., 2/3 annotators agree that a particular span is toxic)
+            # That's why we filter it with this value
+            span_indices = [idx for idx, p in span_probs.items() if p >= 0.5]
+            if len(span_indices) > 0:
+                examples.append((row["text_of_post"], list(zip(span_indices, labels))))
 
     nlp = spacy.blank("en")
     docs = []
-    for eg in examples:
-        doc = nlp(eg["text_of_post"])
-        span_indices = ast.literal_eval(eg["probability"])
-        labels = ast.literal_eval(eg["type"])
-        # In toxic-spans, we only have labels for spans where the annotator score
-        # is > 0.5 (i.e., 2/3 annotators agree that a particular span is toxic)
-        # That's why we filter it with this value
-        span_indices = [idx for idx, p in span_indices.items() if p >= 0.5]
-        if len(span_indices) > 0:
-            spans = []
-            for span_idx, label in zip(span_indices, labels):
-                start, end = span_idx
-                span = doc.char_span(start, end, label=label, alignment_mode="expand")
-                spans.append(span)
-            if use_ents:
-                try:
-                    doc.set_ents(spans)
-                except ValueError:
-                    # FIXME: There are 12 spans that overlap, but are mostly due to annotation errors
-                    # Will find a way to include them (or remove them altogether)
-                    pass
-            else:
-                group = SpanGroup(doc, name=spans_key, spans=spans)
-                doc.spans[spans_key] = group
-            docs.append(doc)
+    counts: Counter = Counter()
+    texts = (text for text, _ in examples)
+    for doc, (_, offsets) in zip(nlp.pipe(texts, n_process=n_process, batch_size=BATCH_SIZE), examples):
+        spans = _align_spans(doc, offsets, counts)
+        if use_ents:
+            # Doc.ents can't overlap, keep the longest of overlapping spans.
+            ents = filter_spans(spans)
+            counts["overlapping"] += len(spans) - len(ents)
+            doc.set_ents(ents)
+        else:
+            group = SpanGroup(doc, name=spans_key, spans=spans)
+            doc.spans[spans_key] = group
+        docs.append(doc)
 
+    msg.info(
+        f"Aligned spans to tokens: {counts['exact']} exact, "
+        f"{counts['expanded']} expanded, {counts['trimmed']} trimmed "
+        f"and {counts['dropped']} dropped"
+    )
+    if use_ents:
+        msg.info(f"Dropped {counts['overlapping']} overlapping spans from Doc.ents")
     msg.info(f"Processed {len(docs)} docs")
 
+    if n_folds:
+        # Cross-validation as in the paper, the folds only store doc ids.
+        if stratify:
+            index = SpanIndex.from_docs(docs, None if use_ents else spans_key)
+            folds = stratified_split(
+                len(docs), index.doc_id, index.label, [1 / n_folds] * n_folds, seed=seed
+            )
+        else:
+            folds = kfold_split(len(docs), n_folds, shuffle=shuffle, seed=seed)
+        output_file = output_dir / f"{ID}.spacy"
+        _write_corpus(
+            output_file,
+            docs,
+            spans_key=None if use_ents else spans_key,
+            shard_size=shard_size,
+            docbin_format=docbin_format,
+        )
+        write_folds(output_file, folds)
+        msg.good(f"Saved {n_folds} folds of the dataset to {output_file}")
+        return
+
     # Split the dataset 80/10/10 based from the paper
     # TODO: Note that they actually did cross-validation here. For now
-    # I'll do a straightforward split.
-    if shuffle:
-        msg.info("Shuffling docs before splitting")
-        if seed:
-            msg.info(f"Using random seed '{seed}'")
-            random.seed(seed)
-        random.shuffle(docs)
-
-    # Separate training and test
-    train_dev_size = int(len(docs) * (TRAIN_SIZE + DEV_SIZE))
-    train_dev_docs = docs[:train_dev_size]
-    test_docs = docs[train_dev_size:]
-
-    # Get dev set from training
-    train_size = int(len(docs) * TRAIN_SIZE)
-    train_docs = train_dev_docs[:train_size]
-    dev_docs = train_dev_docs[train_size:]
+    # I'll do a straightforward split, see --n-folds for cross-validation.
+    if stratify:
+        msg.info("Stratifying the split by span label")
+        index = SpanIndex.from_docs(docs, None if use_ents else spans_key)
+        splits = stratified_split(
+            len(docs), index.doc_id, index.label, [TRAIN_SIZE, DEV_SIZE, TEST_SIZE], seed=seed
+        )
+        train_docs, dev_docs, test_docs = (
+            [doc for doc, split in zip(docs, splits) if split == split_id]
+            for split_id in range(3)
+        )
+    else:
+        if shuffle:
+            msg.info("Shuffling docs before splitting")
+            if seed:
+                msg.info(f"Using random seed '{seed}'")
+                random.seed(seed)
+            random.shuffle(docs)
+
+        # Separate training and test
+        train_dev_size = int(len(docs) * (TRAIN_SIZE + DEV_SIZE))
+        train_dev_docs = docs[:train_dev_size]
+        test_docs = docs[train_dev_size:]
+
+        # Get dev set from training
+        train_size = int(len(docs) * TRAIN_SIZE)
+        train_docs = train_dev_docs[:train_size]
+        dev_docs = train_dev_docs[train_size:]
 
     msg.info(
         f"Split datasets into train ({len(train_docs)}), "
@@ -97,9 +239,14 @@ def convert_toxic_spans(
     datasets = [("train", train_docs), ("dev", dev_docs), ("test", test_docs)]
 
     for name, _docs in datasets:
-        doc_bin = DocBin(docs=_docs)
         output_file = output_dir / f"{ID}-{name}.spacy"
-        doc_bin.to_disk(output_file)
+        _write_corpus(
+            output_file,
+            _docs,
+            spans_key=None if use_ents else spans_key,
+            shard_size=shard_size,
+            docbin_format=docbin_format,
+        )
         msg.good(f"Saved {name} dataset to {output_file}")
 
 
@@ -1,36 +1,96 @@
 import random
 from pathlib import Path
+from typing import List, Optional, Sequence
 
+import numpy
 import typer
-from spacy.tokens import DocBin
 from spacy.util import get_lang_class
 from wasabi import msg
+from ._util import LazyDocBin, load_span_index, stored_spans_key
 
 Arg = typer.Argument
 Opt = typer.Option
 
 
+def _candidates(
+    corpus: LazyDocBin,
+    *,
+    labels: Sequence[str],
+    min_length: int,
+    max_length: Optional[int],
+    start: int,
+    end: Optional[int],
+    spans_key: Optional[str],
+) -> Sequence[int]:
+    """
+    The ids of the docs in [start, end) with a span that passes the
+    filters, found in the corpus' SpanIndex. Without span filters
+    it's just the range, which isn't materialized.
+    """
+    end = len(corpus) if end is None else min(end, len(corpus))
+    if not labels and min_length <= 1 and max_length is None:
+        return range(start, end)
+    index = load_span_index(corpus.path, spans_key)
+    mask = index.length >= min_length
+    if max_length is not None:
+        mask &= index.length <= max_length
+    if labels:
+        label_ids = [i for i, label in enumerate(index.labels) if label in labels]
+        mask &= numpy.isin(index.label, label_ids)
+    doc_ids = numpy.unique(index.doc_id[mask])
+    doc_ids = doc_ids[(doc_ids >= start) & (doc_ids < end)]
+    return doc_ids.tolist()
+
+
 def view_spans(
     # fmt: off
     input_path: Path = Arg(..., help="Input spaCy file", exists=True),
     lang: str = Opt("xx", "--lang", "-l", help="Language for the vocab"),
     display_size: int = Opt(3, "--size", "-sz", help="Number of Doc.spans to show"),
-    shuffle: bool = Opt(False, "--shuffle", "-s", help="Shuffle the items")
+    shuffle: bool = Opt(False, "--shuffle", "-s", help="Show a random sample of the docs"),
+    seed: Optional[int] = Opt(None, "--seed", "-sd", help="Random seed for the sample"),
+    labels: List[str] = Opt([], "--label", "-lb", help="Only show docs with a span of this label, can be repeated"),
+    min_length: int = Opt(1, "--min-length", help="Only show docs with a span of at least this many tokens"),
+    max_length: Optional[int] = Opt(None, "--max-length", help="Only show docs with a span of at most this many tokens"),
+    start: int = Opt(0, "--start", help="First doc id to show"),
+    end: Optional[int] = Opt(None, "--end", help="Only show docs before this doc id"),
+    spans_key: Optional[str] = Opt(None, "--spans-key", "-sk", help="Spans key to filter on, the corpus' own key or Doc.ents if not given"),
     # fmt: on
 ):
-    """Helper function to check if spans were saved correctly"""
-    nlp = get_lang_class(lang)()
-    db = DocBin().from_disk(input_path)
-    docs = list(db.get_docs(nlp.vocab))
-    msg.info(f"Found {len(docs)} docs in {str(input_path)}")
-    msg.info(f"Showing {display_size} docs")
+    """
+    Helper function to check if spans were saved correctly.
 
+    Only the docs that are shown are decoded. The docs are picked from
+    the doc ids in [--start, --end) and with --label, --min-length or
+    --max-length from the docs with a matching span in the corpus'
+    SpanIndex, in order or as a random sample with --shuffle.
+    """
+    nlp = get_lang_class(lang)()
+    corpus = LazyDocBin(input_path)
+    msg.info(f"Found {len(corpus)} docs in {str(input_path)}")
+    if spans_key is None:
+        spans_key = stored_spans_key(input_path)
+    doc_ids = _candidates(
+        corpus,
+        labels=labels,
+        min_length=min_length,
+        max_length=max_length,
+        start=start,
+        end=end,
+        spans_key=spans_key,
+    )
+    size = min(display_size, len(doc_ids))
+    msg.info(f"Showing {size} of {len(doc_ids)} matching docs")
     if shuffle:
-        random.shuffle(docs)
-    for doc in docs[:display_size]:
-        msg.divider()
+        # Decode the sample in doc id order, a shard at a time.
+        sample = sorted(random.Random(seed).sample(doc_ids, size))
+    else:
+        sample = doc_ids[:size]
+    for i in sample:
+        doc = corpus.get_doc(i, nlp.vocab)
+        msg.divider(f"Doc {i}")
         msg.text(doc.text)
-        msg.text(doc.spans, color="yellow")
+        msg.text(doc.ents if spans_key is None else doc.spans, color="yellow")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,34 @@
+import sys
+from pathlib import Path
+
+import numpy
+import spacy
+from spacy.tokens import DocBin, Span
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "scripts"))
+
+from _util import VectorKeys  # noqa: E402
+from analyze import analyze_split  # noqa: E402
+
+
+def _write_corpus(path: Path, text: str) -> None:
+    nlp = spacy.blank("xx")
+    doc = nlp(text)
+    doc.ents = [Span(doc, 0, 1, "PER")]
+    DocBin(docs=[doc]).to_disk(path)
+
+
+def test_analyze_split_languages_of_one_dataset(tmp_path):
+    vocab = spacy.blank("xx").vocab
+    vectors = VectorKeys(numpy.zeros((0,), dtype="uint64"))
+    output_dir = tmp_path / "analyses"
+    output_dir.mkdir()
+    for lang, text in [("es", "Juan vive aquí"), ("nl", "Jan woont hier")]:
+        path = tmp_path / f"{lang}-conll-train.spacy"
+        _write_corpus(path, text)
+        analyze_split(str(path), vocab, vectors, output_dir=str(output_dir))
+    assert (output_dir / "es-conll-train.csv").exists()
+    assert (output_dir / "nl-conll-train.csv").exists()
+    assert (output_dir / "es-conll-train.vocab").read_text() != (
+        output_dir / "nl-conll-train.vocab"
+    ).read_text()